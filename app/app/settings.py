@@ -22,6 +22,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'core',
@@ -74,6 +75,33 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Shared by the worker processes, as the recipe app keeps its collection
+# versions here. Set MEMCACHED_LOCATION (host:port) to use memcached, which
+# is needed on several hosts and has atomic add() and incr(). The file based
+# cache's are a read then a write: the stampede lock of the response cache
+# is only best effort there and concurrent hits may go uncounted. Its
+# MAX_ENTRIES is raised well past the per-user keys, as a cull deletes a
+# third of the entries, versions and counters included.
+
+if os.environ.get('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['MEMCACHED_LOCATION'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': '/vol/web/cache',
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -116,4 +144,41 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = '/vol/web/media'
 STATIC_ROOT = 'vol/web/static'
 
-AUTH_USER_MODEL = 'core.User'
\ No newline at end of file
+AUTH_USER_MODEL = 'core.User'
+
+
+# Recipe app
+
+# Cache holding the per-user collection versions behind the list ETags and
+# the in-memory indexes. It must be shared by all workers, process local
+# backends are refused by the recipe.E001 system check.
+RECIPE_CACHE_ALIAS = 'default'
+
+# Cache list responses per user, keyed by the collection version above,
+# in a cache shared by all workers (the recipe.E002 system check)
+RECIPE_RESPONSE_CACHE = True
+RECIPE_RESPONSE_CACHE_ALIAS = 'default'
+RECIPE_RESPONSE_CACHE_TIMEOUT = 300
+
+# Build the recipe list from values() rows (RecipeValuesSerializer) instead
+# of model instances and RecipeSerializer. The payload is identical.
+RECIPE_FAST_LIST = False
+
+# Answer the recipe tags/ingredients filters from per-user in-memory bitmaps
+# (recipe.bitmaps) instead of M2M joins. The index is process local and
+# always answers the pantry query.
+RECIPE_BITMAP_INDEX = False
+RECIPE_BITMAP_INDEX_USERS = 1000
+
+# Name recipe images by the SHA-256 of their bytes (core.storage), so the
+# same photo is stored once however many recipes use it
+RECIPE_CONTENT_ADDRESSED_IMAGES = False
+
+# Let the front proxy send media files once the media views authorized
+# them: 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd).
+# For nginx, RECIPE_MEDIA_ACCEL_PREFIX is an internal location aliasing the
+# directory holding MEDIA_ROOT:
+#   location /protected/ { internal; alias /vol/web/; }
+# Left unset, Django sends the files itself, honouring Range requests.
+RECIPE_MEDIA_ACCEL = None
+RECIPE_MEDIA_ACCEL_PREFIX = '/protected/'
@@ -1,10 +1,14 @@
 from django.contrib import admin
 from django.urls import path, include
-from django.conf.urls.static import static
 from django.conf import settings
+from recipe.views import RecipeImageResizeView, RecipeMediaView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/user/', include('user.urls')),
     path('api/recipe/', include('recipe.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path(f"{settings.MEDIA_URL.lstrip('/')}recipe/<int:pk>/",
+         RecipeImageResizeView.as_view(), name='recipe-image-resize'),
+    path(f"{settings.MEDIA_URL.lstrip('/')}<path:name>",
+         RecipeMediaView.as_view(), name='recipe-media'),
+]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+# Expression indexes are not expressible with models.Index on this Django
+# version, so they are created with raw SQL on PostgreSQL only.
+FORWARD_SQL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    "CREATE INDEX core_recipe_title_tsv_idx ON core_recipe "
+    "USING gin (to_tsvector('english'::regconfig, COALESCE(title, '')))",
+    'CREATE INDEX core_recipe_title_trgm_idx ON core_recipe '
+    'USING gin (title gin_trgm_ops)',
+]
+
+BACKWARD_SQL = [
+    'DROP INDEX IF EXISTS core_recipe_title_trgm_idx',
+    'DROP INDEX IF EXISTS core_recipe_title_tsv_idx',
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            for sql in statements:
+                schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_recipe_user_id_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_postgres(FORWARD_SQL), run_on_postgres(BACKWARD_SQL)),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations
+
+
+def merge_duplicate_names(apps, schema_editor):
+    """Normalize names and merge tags/ingredients that only differ by case
+    or whitespace into the oldest one, keeping their recipe links.
+    """
+    Recipe = apps.get_model('core', 'Recipe')
+    for model_name, field in (('Tag', 'tags'), ('Ingredient', 'ingredients')):
+        model = apps.get_model('core', model_name)
+        through = getattr(Recipe, field).through
+        column = f'{model_name.lower()}_id'
+        kept = {}
+        for obj in model.objects.order_by('id').iterator():
+            name = ' '.join(obj.name.split())
+            key = (obj.user_id, name.lower())
+            if key not in kept:
+                kept[key] = obj.id
+                if name != obj.name:
+                    model.objects.filter(id=obj.id).update(name=name)
+                continue
+            linked = through.objects.filter(
+                **{column: kept[key]}
+            ).values_list('recipe_id', flat=True)
+            through.objects.filter(**{column: obj.id}).exclude(
+                recipe_id__in=list(linked)
+            ).update(**{column: kept[key]})
+            obj.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_recipe_title_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_names, migrations.RunPython.noop),
+        # expression indexes can't be declared on the models with this Django version
+        migrations.RunSQL(
+            ['CREATE UNIQUE INDEX core_tag_user_lower_name_uniq '
+             'ON core_tag (user_id, lower(name))'],
+            ['DROP INDEX core_tag_user_lower_name_uniq'],
+        ),
+        migrations.RunSQL(
+            ['CREATE UNIQUE INDEX core_ingredient_user_lower_name_uniq '
+             'ON core_ingredient (user_id, lower(name))'],
+            ['DROP INDEX core_ingredient_user_lower_name_uniq'],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 2.1.15 on 2026-10-18 05:18
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+
+
+def count_recipes(apps, schema_editor):
+    Recipe = apps.get_model('core', 'Recipe')
+    for model_name, field in (('Tag', 'tags'), ('Ingredient', 'ingredients')):
+        through = getattr(Recipe, field).through
+        column = f'{model_name.lower()}_id'
+        counts = through.objects.filter(**{column: OuterRef('pk')}).order_by().values(
+            column).annotate(count=Count('*')).values('count')
+        apps.get_model('core', model_name).objects.filter(
+            recipe__isnull=False
+        ).update(recipe_count=Subquery(counts, output_field=IntegerField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_user_scoped_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='recipe_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='recipe_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='ingredient',
+            index=models.Index(fields=['user', 'recipe_count'], name='core_ingredient_user_count_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['user', 'recipe_count'], name='core_tag_user_count_idx'),
+        ),
+        migrations.RunPython(count_recipes, migrations.RunPython.noop),
+        # SQLite rebuilds the tables to add the columns, losing the indexes of 0010
+        migrations.RunSQL(
+            ['CREATE UNIQUE INDEX IF NOT EXISTS core_tag_user_lower_name_uniq '
+             'ON core_tag (user_id, lower(name))',
+             'CREATE UNIQUE INDEX IF NOT EXISTS core_ingredient_user_lower_name_uniq '
+             'ON core_ingredient (user_id, lower(name))'],
+            migrations.RunSQL.noop,
+        ),
+    ]
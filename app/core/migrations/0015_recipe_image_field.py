@@ -0,0 +1,20 @@
+# Generated by Django 2.1.15 on 2026-10-18 06:17
+
+import core.models
+import core.storage
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_stored_files'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=core.models.RecipeImageField(null=True, storage=core.storage.RecipeImageStorage(), upload_to=core.models.recipe_image_file_path),
+        ),
+    ]
@@ -1,6 +1,11 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.fields.files import ImageFieldFile
+from django.db.models.functions import Coalesce, Lower
+from django.db.models.signals import post_save
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.conf import settings
+from core.storage import RecipeImageStorage
 import uuid
 import os
 
@@ -49,6 +54,72 @@ class User(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = 'email'
 
 
+def normalize_name(name):
+    """Strip a tag/ingredient name and collapse inner whitespace"""
+    return ' '.join(name.split())
+
+
+def name_key(name):
+    """Key of a tag/ingredient name, equal for names differing in case"""
+    return normalize_name(name).lower()
+
+
+class UserNameManager(models.Manager):
+    """Manager for user owned objects with a name unique per user,
+    ignoring case (see the lower(name) indexes of migration 0010).
+    """
+
+    def filter_names(self, user, names):
+        """Objects of user whose lower case name is in names.
+        Both sides are lowered by the database, as in the unique index,
+        whose lower() may differ from Python's for non-ASCII names.
+        """
+        return self.filter(user=user).annotate(
+            lower_name=Lower('name')
+        ).filter(lower_name__in=[Lower(Value(name)) for name in names])
+
+    def recipe_count_expression(self):
+        """Expression counting the recipes linked to each object, for
+        checking and resetting the denormalized recipe_count
+        """
+        through = self.model.recipe_set.through
+        column = through._meta.get_field(self.model._meta.model_name).attname
+        counts = through.objects.filter(**{column: OuterRef('pk')}).order_by().values(
+            column).annotate(count=Count('*')).values('count')
+        return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+
+    def bulk_get_or_create(self, user, names):
+        """Return ({name_key(name): object}, newly created objects),
+        creating whichever names the user doesn't have yet.
+        """
+        wanted = {}
+        for name in map(normalize_name, names):
+            wanted.setdefault(name.lower(), name)
+        existing = set(map(name_key, self.filter_names(user, wanted.values()).values_list(
+            'name', flat=True)))
+        missing = [name for key, name in wanted.items() if key not in existing]
+        if missing:
+            try:
+                with transaction.atomic():
+                    self.bulk_create(self.model(user=user, name=name) for name in missing)
+            except IntegrityError:
+                # a concurrent request inserted some of them, retry one by one
+                for name in missing:
+                    try:
+                        with transaction.atomic():
+                            self.create(user=user, name=name)
+                    except IntegrityError:
+                        pass
+
+        objects = {name_key(obj.name): obj for obj in self.filter_names(user, wanted.values())}
+        created = [objects[name_key(name)] for name in missing]
+        for obj in created:
+            # bulk_create sends no signals
+            post_save.send(sender=self.model, instance=obj, created=True,
+                           update_fields=None, raw=False, using=self.db)
+        return objects, created
+
+
 class Tag(models.Model):
     """Tag to be used for a recipe"""
     name = models.CharField(max_length=30)
@@ -57,6 +128,17 @@ class Tag(models.Model):
         on_delete=models.CASCADE
     )
 
+    # number of recipes using it, kept current by recipe.signals
+    recipe_count = models.PositiveIntegerField(default=0)
+
+    objects = UserNameManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'name'], name='core_tag_user_name_idx'),
+            models.Index(fields=['user', 'recipe_count'], name='core_tag_user_count_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -69,10 +151,38 @@ class Ingredient(models.Model):
         on_delete=models.CASCADE
     )
 
+    # number of recipes using it, kept current by recipe.signals
+    recipe_count = models.PositiveIntegerField(default=0)
+
+    objects = UserNameManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'name'], name='core_ingredient_user_name_idx'),
+            models.Index(fields=['user', 'recipe_count'], name='core_ingredient_user_count_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
 
+class RecipeImageFieldFile(ImageFieldFile):
+    """Saving the file counts a reference to it (see core.storage). The
+    reference is left on the instance, in _taken_images, for the recipe's
+    post_save to take over, or Recipe.save to release if the save fails.
+    """
+
+    def save(self, name, content, save=True):
+        super().save(name, content, save=False)
+        self.instance.__dict__.setdefault('_taken_images', []).append(self.name)
+        if save:
+            self.instance.save()
+
+
+class RecipeImageField(models.ImageField):
+    attr_class = RecipeImageFieldFile
+
+
 class Recipe(models.Model):
     """Recipe object"""
     user = models.ForeignKey(
@@ -85,7 +195,70 @@ class Recipe(models.Model):
     link = models.CharField(max_length=255, blank=True)
     ingredients = models.ManyToManyField('Ingredient')
     tags = models.ManyToManyField('Tag')
-    image = models.ImageField(null=True, upload_to=recipe_image_file_path)
+    image = RecipeImageField(
+        null=True, upload_to=recipe_image_file_path, storage=RecipeImageStorage()
+    )
+
+    class Meta:
+        indexes = [
+            # backs the keyset pagination of a user's recipe list
+            models.Index(fields=['user', 'id'], name='core_recipe_user_id_idx'),
+            # range filters and sorting, id keeps the order of ties for the cursor
+            models.Index(fields=['user', 'time_minutes', 'id'], name='core_recipe_user_time_idx'),
+            models.Index(fields=['user', 'price', 'id'], name='core_recipe_user_price_idx'),
+        ]
 
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return self.title
+
+    def save(self, *args, **kwargs):
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            # references post_save didn't take over, as the save failed
+            taken = self.__dict__.pop('_taken_images', None)
+            if taken:
+                from recipe.signals import release_images
+                release_images(taken)
+
+
+class StoredFileManager(models.Manager):
+
+    def acquire(self, name):
+        """Count one more reference to the stored file name"""
+        if self.filter(name=name).update(ref_count=F('ref_count') + 1):
+            return
+        try:
+            with transaction.atomic():
+                self.create(name=name, ref_count=1)
+        except IntegrityError:
+            # a concurrent first reference created the row
+            self.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+    def release(self, name):
+        """Count one reference less to the stored file name"""
+        self.filter(name=name, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+
+    def collect(self, name):
+        """Forget name if nothing refers to it, returning whether it was.
+        The row stays locked to the end of the transaction, which should
+        delete the file as well.
+        """
+        stored = self.select_for_update().filter(name=name, ref_count=0).first()
+        if stored is None:
+            return False
+        stored.delete()
+        return True
+
+
+class StoredFile(models.Model):
+    """Number of references to a stored file, which may be shared by
+    recipes when images are content addressed (see core.storage)
+    """
+    name = models.CharField(max_length=255, unique=True)
+    ref_count = models.PositiveIntegerField(default=0)
+
+    objects = StoredFileManager()
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,67 @@
+"""Storage of recipe images.
+
+With RECIPE_CONTENT_ADDRESSED_IMAGES on, an image is named by the SHA-256
+of its bytes instead of the random name from recipe_image_file_path, so
+the same photo uploaded again, e.g. by clones and imports, is stored once.
+Names are sharded two levels deep, uploads/recipe/ab/cd/<hash>.ext, to keep
+directories small. As a file may be shared by several recipes, the
+references to it are counted in StoredFile and it is only deleted once
+none are left. Saving a file counts a reference to it, which the field
+hands over to the recipe saved with it (see core.models.RecipeImageFieldFile).
+"""
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+
+
+def content_addressed():
+    return getattr(settings, 'RECIPE_CONTENT_ADDRESSED_IMAGES', False)
+
+
+def hashed_name(name, content):
+    """Return the sharded name of content, keeping the directory and
+    extension of name. The content is hashed in chunks, not read at once.
+    """
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    key = digest.hexdigest()
+    head, tail = os.path.split(name)
+    ext = os.path.splitext(tail)[1].lower()
+    return os.path.join(head, key[:2], key[2:4], key + ext)
+
+
+@deconstructible
+class RecipeImageStorage(FileSystemStorage):
+    """FileSystemStorage deduplicating content addressed images and
+    keeping files that are still referenced. Saving a file counts a
+    reference to it, before a stored file is reused, so collecting its
+    last previous reference can't delete it from under the new one.
+    """
+
+    def _save(self, name, content):
+        from core.models import StoredFile
+        if not content_addressed():
+            name = super()._save(name, content)
+            StoredFile.objects.acquire(name)
+        else:
+            name = hashed_name(name, content)
+            with transaction.atomic():
+                # the count is updated first, which waits for a collect of
+                # the file to commit or keeps it from collecting the file
+                StoredFile.objects.acquire(name)
+                if not self.exists(name):
+                    name = super()._save(name, content)
+        return name
+
+    def delete(self, name):
+        """Delete the file unless references to it are still counted"""
+        from core.models import StoredFile
+        if name and StoredFile.objects.filter(name=name, ref_count__gt=0).exists():
+            return
+        super().delete(name)
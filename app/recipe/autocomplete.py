@@ -0,0 +1,65 @@
+"""Per-user in-memory prefix lookup of tag and ingredient names.
+
+Each user's names are held in an array sorted by lower case name, so the
+names starting with a prefix are one contiguous slice found by binary
+search, then ranked by recipe_count. An index is tagged with the user's
+collection version (recipe.versions) and rebuilt on the first lookup after
+any write, which also keeps processes from serving each other's stale
+names. The least recently used users are evicted past
+RECIPE_AUTOCOMPLETE_USERS.
+"""
+import heapq
+from bisect import bisect_left, bisect_right
+
+from core.models import normalize_name
+from recipe import versions
+
+
+class NameIndex:
+    """One user's tags or ingredients sorted by lower case name."""
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda row: (row[1].lower(), row[0]))
+        self.keys = [name.lower() for _, name, _ in rows]
+        self.rows = rows        # (id, name, recipe_count)
+
+    def complete(self, prefix, limit=10):
+        """Return the rows whose name starts with prefix, ignoring case,
+        most used first
+        """
+        prefix = normalize_name(prefix).lower()
+        start = bisect_left(self.keys, prefix)
+        stop = bisect_right(self.keys, prefix + '\U0010ffff', lo=start)
+        rows = self.rows
+        # keeps name order among equal counts, the slice is sorted by name
+        return [rows[i] for i in heapq.nsmallest(
+            limit, range(start, stop), key=lambda i: -rows[i][2]
+        )]
+
+    @classmethod
+    def build(cls, user_id, model):
+        return cls(model.objects.filter(user_id=user_id).values_list(
+            'id', 'name', 'recipe_count'
+        ))
+
+
+_indexes = versions.IndexCache(NameIndex, 'RECIPE_AUTOCOMPLETE_USERS')
+
+
+def get_index(model, user_id):
+    """Return the user's index of model names, (re)building it if the
+    user's collections changed since it was built
+    """
+    return _indexes.get(user_id, model)
+
+
+def complete(model, user_id, prefix, limit=10):
+    """Return up to limit (id, name, recipe_count) of the user's names
+    starting with prefix, most used first
+    """
+    return get_index(model, user_id).complete(prefix, limit)
+
+
+def clear():
+    """Drop every index"""
+    _indexes.clear()
@@ -0,0 +1,173 @@
+"""Per-user in-memory bitmap index of recipes by tag and ingredient.
+
+Each user gets a dense numbering of their recipes, and every tag and
+ingredient maps to a Python int whose set bits are the positions of the
+recipes it is attached to. Filtering then becomes integer AND/OR instead of
+M2M joins. The index is process local and kept current in place by the
+m2m_changed/post_delete receivers in recipe.signals once their writes
+commit. It is tagged with the user's collection version (recipe.versions),
+so writes of other processes or rolled back ones rebuild it. The positions
+of deleted recipes are handed out again, so the bitmaps don't grow with
+churn.
+"""
+from functools import reduce
+from itertools import compress
+from operator import and_, or_
+
+from django.conf import settings
+
+from core.models import Recipe
+from recipe import versions
+
+FIELDS = ('tags', 'ingredients')
+
+# bin() digits to bytes compress() can select recipe ids with
+_BITS = bytes.maketrans(b'01', b'\x00\x01')
+
+
+def enabled():
+    """Return True if recipe filters should be answered from the index"""
+    return getattr(settings, 'RECIPE_BITMAP_INDEX', False)
+
+
+class RecipeBitmapIndex:
+    """Bitmaps of one user's recipe positions per tag and ingredient."""
+
+    def __init__(self):
+        self.positions = {}         # recipe id -> bit position
+        self.recipe_ids = []        # bit position -> recipe id, None if free
+        self.free = []              # positions of deleted recipes
+        self.bitmaps = {field: {} for field in FIELDS}
+
+    def _position(self, recipe_id):
+        pos = self.positions.get(recipe_id)
+        if pos is None:
+            if self.free:
+                pos = self.free.pop()
+                self.recipe_ids[pos] = recipe_id
+            else:
+                pos = len(self.recipe_ids)
+                self.recipe_ids.append(recipe_id)
+            self.positions[recipe_id] = pos
+        return pos
+
+    def add(self, field, attr_id, recipe_id):
+        """Mark recipe as having the tag/ingredient attr_id"""
+        bitmaps = self.bitmaps[field]
+        bitmaps[attr_id] = bitmaps.get(attr_id, 0) | (1 << self._position(recipe_id))
+
+    def remove(self, field, attr_id, recipe_id):
+        """Unmark recipe as having the tag/ingredient attr_id"""
+        pos = self.positions.get(recipe_id)
+        bitmaps = self.bitmaps[field]
+        if pos is not None and attr_id in bitmaps:
+            bitmaps[attr_id] &= ~(1 << pos)
+
+    def clear_recipe(self, field, recipe_id):
+        """Unmark recipe from every bitmap of field"""
+        pos = self.positions.get(recipe_id)
+        if pos is None:
+            return
+        mask = ~(1 << pos)
+        bitmaps = self.bitmaps[field]
+        for attr_id in bitmaps:
+            bitmaps[attr_id] &= mask
+
+    def drop_recipe(self, recipe_id):
+        """Forget a deleted recipe, freeing its position"""
+        for field in FIELDS:
+            self.clear_recipe(field, recipe_id)
+        pos = self.positions.pop(recipe_id, None)
+        if pos is not None:
+            self.recipe_ids[pos] = None
+            self.free.append(pos)
+
+    def drop_attr(self, field, attr_id):
+        """Forget a deleted tag/ingredient"""
+        self.bitmaps[field].pop(attr_id, None)
+
+    def bitmap(self, field, attr_ids, match_all=False):
+        """Combine the bitmaps of attr_ids with AND or OR"""
+        bitmaps = self.bitmaps[field]
+        return reduce(
+            and_ if match_all else or_,
+            (bitmaps.get(attr_id, 0) for attr_id in attr_ids),
+        )
+
+    def resolve(self, tag_ids=None, ingredient_ids=None, match_all=False):
+        """Return the ids of recipes matching the tag and ingredient filters.
+        Within a filter the ids are OR-ed, or AND-ed with match_all; the two
+        filters are always AND-ed together.
+        """
+        result = None
+        for field, attr_ids in (('tags', tag_ids), ('ingredients', ingredient_ids)):
+            if attr_ids:
+                bitmap = self.bitmap(field, attr_ids, match_all)
+                result = bitmap if result is None else result & bitmap
+        if not result:
+            return []
+        return self.recipe_ids_for(result)
+
+    def missing(self, ingredient_ids, max_missing=0):
+        """Return {recipe id: number of ingredients not in ingredient_ids}
+        for the recipes lacking at most max_missing of their ingredients.
+        Counts are kept as saturating bit planes, so every step works on all
+        recipes at once: after the loop at_least[j] marks the recipes
+        missing more than j ingredients.
+        """
+        pantry = set(ingredient_ids)
+        at_least = [0] * (max_missing + 1)
+        candidates = 0
+        for attr_id, bitmap in list(self.bitmaps['ingredients'].items()):
+            candidates |= bitmap
+            if attr_id in pantry:
+                continue
+            for j in range(max_missing, 0, -1):
+                at_least[j] |= at_least[j - 1] & bitmap
+            at_least[0] |= bitmap
+        counts = {}
+        for j, more in enumerate(at_least):
+            for recipe_id in self.recipe_ids_for(candidates & ~more):
+                counts[recipe_id] = j
+            candidates &= more
+        return counts
+
+    def recipe_ids_for(self, bitmap):
+        """Decode a bitmap back into recipe ids"""
+        # least significant bit first, as 0/1 bytes
+        bits = bin(bitmap)[:1:-1].encode().translate(_BITS)
+        return list(compress(self.recipe_ids, bits))
+
+    @classmethod
+    def build(cls, user_id, fields=FIELDS):
+        """Load the index for a user from the M2M tables"""
+        index = cls()
+        for field in fields:
+            through = getattr(Recipe, field).through
+            attr_column = through._meta.get_field(field[:-1]).attname
+            rows = through.objects.filter(
+                recipe__user_id=user_id
+            ).values_list(attr_column, 'recipe_id').order_by('recipe_id')
+            for attr_id, recipe_id in rows:
+                index.add(field, attr_id, recipe_id)
+        return index
+
+
+_indexes = versions.IndexCache(
+    RecipeBitmapIndex, 'RECIPE_BITMAP_INDEX_USERS', follows_writes=True
+)
+
+
+def get_index(user_id):
+    """Return the user's index, (re)building it if needed"""
+    return _indexes.get(user_id)
+
+
+def update(user_id, func, *args):
+    """Apply func to the user's index once the transaction commits"""
+    _indexes.update(user_id, func, *args)
+
+
+def clear():
+    """Drop every index"""
+    _indexes.clear()
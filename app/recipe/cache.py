@@ -0,0 +1,76 @@
+"""Per-user cache of recipe app list responses.
+
+Keys embed the user's collection version (recipe.versions), so the writes
+that bump it through recipe.signals invalidate every cached list of that
+user at once. Only one request per key rebuilds a missing entry; the others
+wait for it instead of stampeding the database. The lock and the hit/miss
+counters rely on the atomic add() and incr() of memcached, on the file based
+cache the lock is best effort and counts may be lost under concurrency.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+HITS_KEY = 'recipe:cache:hits'
+MISSES_KEY = 'recipe:cache:misses'
+
+
+def _cache():
+    return caches[getattr(settings, 'RECIPE_RESPONSE_CACHE_ALIAS', 'default')]
+
+
+def enabled():
+    return getattr(settings, 'RECIPE_RESPONSE_CACHE', True)
+
+
+def make_key(request, version):
+    """Key a list response by user, version, endpoint and query params"""
+    params = sorted(
+        (name, value) for name, values in request.query_params.lists() for value in values
+    )
+    variant = f'{request.path}?{params}'
+    digest = hashlib.md5(variant.encode()).hexdigest()
+    return f'recipe:response:{request.user.id}:{version}:{digest}'
+
+
+def _count(key):
+    cache = _cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def stats():
+    """Return the hit and miss counts shared by all processes"""
+    counts = _cache().get_many([HITS_KEY, MISSES_KEY])
+    return {'hits': counts.get(HITS_KEY, 0), 'misses': counts.get(MISSES_KEY, 0)}
+
+
+def get_or_compute(key, compute):
+    """Return (data, hit) for key, computing and storing data on a miss"""
+    cache = _cache()
+    timeout = getattr(settings, 'RECIPE_RESPONSE_CACHE_TIMEOUT', 300)
+    lock_timeout = getattr(settings, 'RECIPE_RESPONSE_CACHE_LOCK_TIMEOUT', 5)
+
+    data = cache.get(key)
+    if data is None and not cache.add(f'{key}:lock', 1, lock_timeout):
+        # another request is building this entry, wait for it
+        deadline = time.monotonic() + lock_timeout
+        while data is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+            data = cache.get(key)
+    if data is not None:
+        _count(HITS_KEY)
+        return data, True
+
+    try:
+        data = compute()
+        cache.set(key, data, timeout)
+    finally:
+        cache.delete(f'{key}:lock')
+    _count(MISSES_KEY)
+    return data, False
@@ -0,0 +1,39 @@
+"""System checks of the recipe app settings."""
+from django.conf import settings
+from django.core.checks import Error, register
+
+# backends whose entries are private to one process
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def _check_shared_cache(setting, error_id):
+    alias = getattr(settings, setting, 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend is None:
+        return [Error(f'{setting} names the cache {alias!r}, which is not in CACHES.',
+                      id=error_id)]
+    if backend in PROCESS_LOCAL_CACHES:
+        return [Error(
+            f'{setting} names the cache {alias!r}, which is private to each process.',
+            hint='Other workers would miss the writes made in this one. '
+                 'Use a shared backend such as memcached or the file based cache.',
+            id=error_id,
+        )]
+    return []
+
+
+@register()
+def check_version_cache(app_configs, **kwargs):
+    """The collection versions must be seen by every worker"""
+    return _check_shared_cache('RECIPE_CACHE_ALIAS', 'recipe.E001')
+
+
+@register()
+def check_response_cache(app_configs, **kwargs):
+    """Cached lists must be dropped in every worker after a write"""
+    if not getattr(settings, 'RECIPE_RESPONSE_CACHE', True):
+        return []
+    return _check_shared_cache('RECIPE_RESPONSE_CACHE_ALIAS', 'recipe.E002')
@@ -0,0 +1,151 @@
+"""Fixed size variants of recipe images, rendered off the request path.
+
+After an upload commits, the original's bytes are handed to a process pool
+that resizes them with Pillow, and the variants are saved through the
+default storage next to the original under predictable names, so their
+URLs can be served before they exist. Until a variant is written its URL
+is a 404 and clients fall back to the original.
+"""
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# name -> (width, height, crop); cropped variants fill the box exactly,
+# the others are scaled down to fit in it
+VARIANTS = OrderedDict([
+    ('thumb', (150, 150, True)),
+    ('card', (600, 400, True)),
+    ('full', (1600, 1600, False)),
+])
+
+_lock = threading.Lock()
+_executor = None
+
+
+def variant_name(name, variant):
+    """Return the storage name of a variant of the image stored at name"""
+    head, tail = os.path.split(name)
+    stem = os.path.splitext(tail)[0]
+    return os.path.join(head, 'variants', f'{stem}_{variant}.jpg')
+
+
+def original_prefix(name):
+    """Return the name up to the extension of the original image of the
+    variant stored at name, or None if name isn't a variant name
+    """
+    head, tail = os.path.split(name)
+    stem, _, variant = os.path.splitext(tail)[0].rpartition('_')
+    if os.path.basename(head) != 'variants' or variant not in VARIANTS or \
+            tail != f'{stem}_{variant}.jpg':
+        return None
+    return os.path.join(os.path.dirname(head), f'{stem}.')
+
+
+def variant_urls(name, request=None):
+    """Return {variant: url} for the image stored at name, or None"""
+    if not name:
+        return None
+    urls = OrderedDict()
+    for variant in VARIANTS:
+        url = default_storage.url(variant_name(name, variant))
+        urls[variant] = request.build_absolute_uri(url) if request is not None else url
+    return urls
+
+
+def render_variants(data):
+    """Return {variant: JPEG bytes} for the image bytes in data.
+    Runs in the worker processes, so it only touches Pillow.
+    """
+    image = Image.open(io.BytesIO(data))
+    # upright as the camera's EXIF orientation says, the variants carry no EXIF
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    rendered = {}
+    for variant, (width, height, crop) in VARIANTS.items():
+        if crop:
+            resized = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            resized = image.copy()
+            resized.thumbnail((width, height), Image.LANCZOS)
+        out = io.BytesIO()
+        resized.save(out, format='JPEG', quality=85, optimize=True, progressive=True)
+        rendered[variant] = out.getvalue()
+    return rendered
+
+
+def save_variants(name, rendered):
+    for variant, data in rendered.items():
+        target = variant_name(name, variant)
+        # names are derived from the original, replace rather than rename
+        default_storage.delete(target)
+        default_storage.save(target, ContentFile(data))
+
+
+def delete_variants(name):
+    for variant in VARIANTS:
+        default_storage.delete(variant_name(name, variant))
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, 'RECIPE_IMAGE_WORKERS', 2)
+            )
+        return _executor
+
+
+def submit(fn, *args):
+    """Run fn(*args) in the process pool, replacing the pool if a crashed
+    worker broke it
+    """
+    global _executor
+    executor = get_executor()
+    try:
+        return executor.submit(fn, *args)
+    except BrokenProcessPool:
+        # its workers are gone already, start a new pool
+        with _lock:
+            if _executor is executor:
+                _executor = None
+        return get_executor().submit(fn, *args)
+
+
+def _rendered(name, done, rendering):
+    try:
+        save_variants(name, rendering.result())
+    except Exception as exc:
+        logger.exception('Could not render the variants of %s', name)
+        done.set_exception(exc)
+    else:
+        done.set_result(name)
+
+
+def generate_variants(name):
+    """Render the variants of the image stored at name in the process
+    pool, returning a future resolved once they are saved
+    """
+    with default_storage.open(name, 'rb') as original:
+        data = original.read()
+    done = Future()
+    rendering = submit(render_variants, data)
+    rendering.add_done_callback(partial(_rendered, name, done))
+    return done
+
+
+def schedule_variants(name):
+    """Generate the variants once the current transaction commits"""
+    transaction.on_commit(partial(generate_variants, name))
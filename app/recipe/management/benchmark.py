@@ -0,0 +1,67 @@
+"""Helpers shared by the recipe benchmark commands."""
+import random
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from core.models import Tag, Ingredient, Recipe
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    """Run the block in a transaction that is always rolled back"""
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+def seed_user(email, recipes, tags=50, ingredients=200, per_recipe=4):
+    """Create a user owning recipes linked to random tags and ingredients"""
+    user = get_user_model().objects.create_user(email, 'bench')
+    # ids are re-read since not every backend returns them from bulk_create
+    Tag.objects.bulk_create(Tag(user=user, name=f'tag {i}') for i in range(tags))
+    tag_ids = list(Tag.objects.filter(user=user).values_list('id', flat=True))
+    Ingredient.objects.bulk_create(
+        Ingredient(user=user, name=f'ingredient {i}') for i in range(ingredients)
+    )
+    ingredient_ids = list(Ingredient.objects.filter(user=user).values_list('id', flat=True))
+    Recipe.objects.bulk_create(
+        Recipe(user=user, title=f'recipe {i}', time_minutes=i % 120, price=i % 100)
+        for i in range(recipes)
+    )
+    recipe_ids = list(Recipe.objects.filter(user=user).values_list('id', flat=True))
+    Recipe.tags.through.objects.bulk_create(
+        Recipe.tags.through(recipe_id=recipe_id, tag_id=tag_id)
+        for recipe_id in recipe_ids
+        for tag_id in random.sample(tag_ids, per_recipe)
+    )
+    Recipe.ingredients.through.objects.bulk_create(
+        Recipe.ingredients.through(recipe_id=recipe_id, ingredient_id=ingredient_id)
+        for recipe_id in recipe_ids
+        for ingredient_id in random.sample(ingredient_ids, per_recipe)
+    )
+    # the links were inserted without m2m_changed
+    for model in (Tag, Ingredient):
+        model.objects.filter(user=user).update(
+            recipe_count=model.objects.recipe_count_expression()
+        )
+    return user
+
+
+def best_of(repeat, func):
+    """Return the fastest of repeat timed calls, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.models import Tag
+from recipe.management.benchmark import best_of, rolled_back, seed_user
+from recipe.views import TagViewSet
+
+
+class Command(BaseCommand):
+    """Compare the previous assigned_only plan, a join over the recipe tags
+    followed by DISTINCT, with the EXISTS semi-join and the min_recipes
+    count subquery, on one heavy user's tags.
+    """
+    help = 'Benchmark the assigned_only tag filter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, default=20000)
+        parser.add_argument('--tags', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            user = seed_user('bench@example.com', options['recipes'], tags=options['tags'])
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            view = TagViewSet()
+            tags = Tag.objects.filter(user=user)
+            plans = {
+                'join + distinct': tags.filter(
+                    recipe__isnull=False).order_by('-name').distinct(),
+                'exists': view._filter_recipe_count(tags, 1).order_by('-name'),
+                'min_recipes=50': view._filter_recipe_count(tags, 50).order_by('-name'),
+            }
+            for name, queryset in plans.items():
+                timing = best_of(options['repeat'], lambda: list(queryset.all()))
+                self.stdout.write(self.style.MIGRATE_HEADING(
+                    f'{name:<16} {timing * 1000:8.2f} ms, {queryset.count()} tags'
+                ))
+                for line in queryset.explain().splitlines():
+                    self.stdout.write(f'    {line}')
@@ -0,0 +1,47 @@
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import Tag
+from recipe import autocomplete
+from recipe.management.benchmark import rolled_back, seed_user
+
+
+class Command(BaseCommand):
+    """Measure autocomplete lookups on one user with many tags: the lazy
+    build, then p50/p99 latency of warm lookups for random 1-3 letter
+    prefixes, version check included.
+    """
+    help = 'Benchmark the tag autocomplete index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--names', type=int, default=10000)
+        parser.add_argument('--lookups', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            user = seed_user('bench@example.com', 0, tags=0, ingredients=0)
+            Tag.objects.bulk_create(
+                Tag(user=user, recipe_count=random.randrange(100),
+                    name=''.join(random.choices(string.ascii_lowercase, k=8)) + f' {i}')
+                for i in range(options['names'])
+            )
+            autocomplete.clear()
+            start = time.perf_counter()
+            autocomplete.get_index(Tag, user.id)
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'build {(time.perf_counter() - start) * 1000:.1f} ms'
+            ))
+
+            timings = []
+            for _ in range(options['lookups']):
+                prefix = ''.join(random.choices(string.ascii_lowercase, k=random.randint(1, 3)))
+                start = time.perf_counter()
+                autocomplete.complete(Tag, user.id, prefix)
+                timings.append(time.perf_counter() - start)
+        timings.sort()
+        for name, q in (('p50', 0.5), ('p99', 0.99), ('max', 1)):
+            timing = timings[min(int(len(timings) * q), len(timings) - 1)]
+            self.stdout.write(f'{name} {timing * 1000:8.3f} ms')
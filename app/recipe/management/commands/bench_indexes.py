@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.models import Tag, Ingredient, Recipe
+from recipe.management.benchmark import best_of, rolled_back, seed_user
+
+# the user scoped indexes of core migrations 0008, 0011 and 0013
+INDEXES = (
+    'core_recipe_user_id_idx',
+    'core_recipe_user_time_idx',
+    'core_recipe_user_price_idx',
+    'core_tag_user_name_idx',
+    'core_ingredient_user_name_idx',
+    'core_recipe_tags_tag_recipe_idx',
+    'core_recipe_ingredients_ingredient_recipe_idx',
+)
+
+
+def hot_queries(user):
+    """The user scoped queries the API runs most, by name"""
+    tag = Tag.objects.filter(user=user).first()
+    ingredient = Ingredient.objects.filter(user=user).first()
+    return {
+        'tag list': Tag.objects.filter(user=user).order_by('-name'),
+        'ingredient list': Ingredient.objects.filter(user=user).order_by('-name'),
+        'recipe page': Recipe.objects.filter(user=user).order_by('-id')[:100],
+        'quick recipes': Recipe.objects.filter(
+            user=user, time_minutes__lte=30).order_by('time_minutes', 'id')[:100],
+        'cheap recipes': Recipe.objects.filter(
+            user=user, price__lte=10).order_by('-price', '-id')[:100],
+        'recipes by tag': Recipe.tags.through.objects.filter(
+            tag_id=tag.id).values_list('recipe_id', flat=True),
+        'recipes by ingredient': Recipe.ingredients.through.objects.filter(
+            ingredient_id=ingredient.id).values_list('recipe_id', flat=True),
+    }
+
+
+class Command(BaseCommand):
+    """Record EXPLAIN plans and timings of the hot user scoped queries with
+    and without the user scoped indexes, on data seeded for many users.
+    The seeded data and dropped indexes are rolled back afterwards.
+    """
+    help = 'Benchmark the user scoped indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--recipes', type=int, default=2000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def measure(self, label, queries, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n{label}'))
+        for name, queryset in queries.items():
+            timing = best_of(repeat, lambda: list(queryset.all()))
+            self.stdout.write(f'{name:<22} {timing * 1000:8.2f} ms')
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f'    {line}')
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            for i in range(options['users']):
+                user = seed_user(f'bench-{i}@example.com', options['recipes'])
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+                queries = hot_queries(user)
+                self.measure('with indexes', queries, options['repeat'])
+                for index in INDEXES:
+                    cursor.execute(f'DROP INDEX {index}')
+                cursor.execute('ANALYZE')
+                self.measure('without indexes', queries, options['repeat'])
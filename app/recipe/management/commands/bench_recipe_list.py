@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from rest_framework.request import Request
+
+from core.models import Recipe
+from recipe.management.benchmark import best_of, rolled_back, seed_user
+from recipe.serializers import RecipeSerializer, RecipeValuesSerializer
+
+
+class Command(BaseCommand):
+    """Compare RecipeSerializer and RecipeValuesSerializer on seeded lists.
+    The seeded data is rolled back afterwards.
+    """
+    help = 'Benchmark the recipe list serializers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        request = Request(RequestFactory().get('/api/recipe/recipes/'))
+        context = {'request': request}
+        for size in options['sizes']:
+            with rolled_back():
+                user = seed_user(f'bench-{size}@example.com', size)
+                recipes = Recipe.objects.filter(user=user).order_by('-id')
+
+                regular = best_of(options['repeat'], lambda: RecipeSerializer(
+                    recipes.prefetch_related('ingredients', 'tags'),
+                    many=True, context=context
+                ).data)
+                fast = best_of(options['repeat'], lambda: RecipeValuesSerializer(
+                    recipes.values(*RecipeValuesSerializer.COLUMNS),
+                    many=True, context=context
+                ).data)
+                self.stdout.write(
+                    f'{size:>6} recipes: serializer {regular * 1000:8.1f} ms, '
+                    f'values {fast * 1000:8.1f} ms, speedup {regular / fast:4.1f}x'
+                )
@@ -0,0 +1,75 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from recipe import similar
+from recipe.management.benchmark import best_of, rolled_back, seed_user
+
+
+def brute_force(index, recipe_id, limit):
+    """Score recipe_id against every recipe of the index"""
+    elements = index.elements[recipe_id]
+    scored = [
+        (pk, similar.jaccard(elements, other))
+        for pk, other in index.elements.items() if pk != recipe_id
+    ]
+    scored.sort(key=lambda item: (-item[1], -item[0]))
+    return scored[:limit]
+
+
+class Command(BaseCommand):
+    """Compare the LSH lookups of recipe.similar with scoring every recipe,
+    on one user's seeded library: latency per lookup, and recall of the
+    brute force top-k recipes at or above --threshold similarity.
+    """
+    help = 'Benchmark the similar recipes index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, default=20000)
+        # small vocabularies so recipes overlap enough to be similar
+        parser.add_argument('--tags', type=int, default=10)
+        parser.add_argument('--ingredients', type=int, default=30)
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument('--threshold', type=float, default=0.5)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        limit, threshold = options['limit'], options['threshold']
+        with rolled_back():
+            user = seed_user(
+                'bench@example.com', options['recipes'],
+                tags=options['tags'], ingredients=options['ingredients'],
+            )
+            start = time.perf_counter()
+            index = similar.SimilarityIndex.build(user.id)
+            timing = time.perf_counter() - start
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'build {timing * 1000:.0f} ms, {len(index.buckets)} buckets'
+        ))
+
+        queries = random.sample(list(index.elements), min(options['queries'], len(index.elements)))
+        found = relevant = candidates = 0
+        for recipe_id in queries:
+            expected = {
+                pk for pk, score in brute_force(index, recipe_id, limit) if score >= threshold
+            }
+            found += len(expected & {pk for pk, _ in index.similar(recipe_id, limit)})
+            relevant += len(expected)
+            candidates += len(index.candidates(recipe_id))
+
+        lookups = {
+            'lsh': lambda recipe_id: index.similar(recipe_id, limit),
+            'brute force': lambda recipe_id: brute_force(index, recipe_id, limit),
+        }
+        for name, lookup in lookups.items():
+            timing = best_of(
+                options['repeat'], lambda: [lookup(recipe_id) for recipe_id in queries]
+            )
+            self.stdout.write(f'{name:<12} {timing / len(queries) * 1000:8.3f} ms per lookup')
+        self.stdout.write(
+            f'recall@{limit} (similarity >= {threshold}): '
+            f'{found / relevant if relevant else 1:.3f}, '
+            f'{candidates / len(queries):.0f} candidates per lookup'
+        )
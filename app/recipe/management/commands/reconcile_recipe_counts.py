@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from core.models import Tag, Ingredient
+
+
+class Command(BaseCommand):
+    """Repair recipe_count drift, e.g. after links were written without
+    m2m_changed. Rows are checked in primary key batches, each in its own
+    transaction, so locks are short and the job can be stopped at any time.
+    """
+    help = 'Recompute recipe_count of tags and ingredients that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Report drifted rows without fixing them'
+        )
+
+    def handle(self, *args, **options):
+        for model in (Tag, Ingredient):
+            fixed = self.reconcile(model, options['batch_size'], options['dry_run'])
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {fixed} drifted')
+
+    def reconcile(self, model, batch_size, dry_run):
+        """Return the number of rows whose recipe_count was wrong"""
+        actual = model.objects.recipe_count_expression()
+        drifted = last_id = 0
+        while True:
+            ids = list(model.objects.filter(pk__gt=last_id).order_by('pk').values_list(
+                'pk', flat=True)[:batch_size])
+            if not ids:
+                return drifted
+            last_id = ids[-1]
+            with transaction.atomic():
+                wrong = list(model.objects.filter(
+                    pk__gte=ids[0], pk__lte=last_id
+                ).annotate(actual=actual).exclude(
+                    recipe_count=F('actual')
+                ).select_for_update().values_list('pk', flat=True))
+                if wrong and not dry_run:
+                    model.objects.filter(pk__in=wrong).update(recipe_count=actual)
+            drifted += len(wrong)
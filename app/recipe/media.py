@@ -0,0 +1,120 @@
+"""Sending media files once a view has authorized them.
+
+With RECIPE_MEDIA_ACCEL set, the response only names the file and the
+front proxy sends it: 'x-accel-redirect' for nginx, with an internal
+location at RECIPE_MEDIA_ACCEL_PREFIX aliasing the directory that holds
+MEDIA_ROOT, or 'x-sendfile' for Apache and lighttpd, with the file's path.
+Without it the file is sent by Django as a FileResponse, which WSGI
+servers with a sendfile file_wrapper (e.g. gunicorn) pass to the kernel,
+honouring a single byte range of a Range header.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.http import http_date
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def accel_root():
+    """Return the directory the accel prefix maps to"""
+    return os.path.dirname(settings.MEDIA_ROOT.rstrip('/'))
+
+
+def parse_range(header, size):
+    """Return (start, end) exclusive of a single range Range header,
+    None to send the whole file, or raise ValueError if unsatisfiable
+    """
+    match = _RANGE_RE.match(header.replace(' ', '')) if header else None
+    if not match or match.groups() == ('', ''):
+        return None     # absent, several ranges or not bytes: send it all
+    first, last = match.groups()
+    if first and last and int(last) < int(first):
+        return None     # invalid, ignored like an absent header
+    if not first:
+        start, end = max(size - int(last), 0), size     # the last N bytes
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    if start >= end:
+        raise ValueError('unsatisfiable range')
+    return start, end
+
+
+class FileRange:
+    """Bytes start..end of an open file. Exposes fileno, so a sendfile
+    file_wrapper sends Content-Length bytes from the current offset.
+    """
+
+    def __init__(self, file, start, end):
+        file.seek(start)
+        self.file = file
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def _accel_response(path, content_type):
+    mode = getattr(settings, 'RECIPE_MEDIA_ACCEL', None)
+    if mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+    if mode == 'x-accel-redirect':
+        relative = os.path.relpath(path, accel_root())
+        if relative.startswith(os.pardir):
+            return None     # outside the aliased directory
+        response = HttpResponse(content_type=content_type)
+        prefix = getattr(settings, 'RECIPE_MEDIA_ACCEL_PREFIX', '/protected/')
+        response['X-Accel-Redirect'] = prefix + quote(relative)
+        return response
+    return None
+
+
+def serve_file(request, path, content_type=None):
+    """Return a response sending the file at path"""
+    content_type = content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = _accel_response(path, content_type)
+    if response is not None:
+        return response
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        raise Http404('No such file.')
+    stat = os.fstat(f.fileno())
+    last_modified = http_date(stat.st_mtime)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    try:
+        byte_range = None if if_range not in (None, last_modified) else parse_range(
+            request.META.get('HTTP_RANGE'), stat.st_size
+        )
+    except ValueError:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+    if byte_range is None:
+        response = FileResponse(f, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(FileRange(f, start, end), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end - 1}/{stat.st_size}'
+        response['Content-Length'] = end - start
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = last_modified
+    return response
@@ -0,0 +1,122 @@
+from base64 import b64decode
+from functools import reduce
+from operator import or_
+from urllib import parse
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class RecipeCursorPagination(CursorPagination):
+    """Keyset pagination for recipes.
+    The cursor holds the values of every ordering field of the last recipe
+    seen, the last one being id, and the next page is fetched with e.g.
+    `time_minutes > t OR (time_minutes = t AND id > i)` against the
+    (user, time_minutes, id) index. Ties are paged by id instead of DRF's
+    capped offset, so deep pages cost the same as the first one however
+    many recipes share a value.
+    """
+    ordering = '-id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_ordering(self, request, queryset, view):
+        """Let the view override the ordering, e.g. by search rank"""
+        ordering = getattr(view, 'cursor_ordering', None) or super().get_ordering(
+            request, queryset, view)
+        if ordering[-1].lstrip('-') != 'id':
+            # ties are paged by id, which must come last
+            ordering = (*ordering, '-id' if ordering[-1].startswith('-') else 'id')
+        return tuple(ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        ordering = [_flip(name) for name in self.ordering] if reverse else self.ordering
+
+        queryset = queryset.order_by(*ordering)
+        if self.cursor is not None and self.cursor.position is not None:
+            try:
+                queryset = queryset.filter(self._after(ordering, self.cursor.position))
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+        # one more than the page tells whether there is a following page
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+        at_start = self.cursor is None or self.cursor.position is None
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, not at_start
+        return self.page
+
+    def _after(self, ordering, position):
+        """Filter to the rows past position in the order of ordering"""
+        if len(position) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        bounds = []
+        for i, name in enumerate(ordering):
+            field = name.lstrip('-')
+            op = 'lt' if name.startswith('-') else 'gt'
+            ties = {prev.lstrip('-'): value for prev, value in zip(ordering[:i], position)}
+            bounds.append(Q(**ties, **{f'{field}__{op}': position[i]}))
+        # the leading bound on its own lets the range scan start at the cursor
+        first = ordering[0]
+        op = 'lte' if first.startswith('-') else 'gte'
+        return Q(**{f'{first.lstrip("-")}__{op}': position[0]}) & reduce(or_, bounds)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[-1], self.ordering)
+        else:
+            position = self.cursor.position     # an emptied page, go on from it
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[0], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(offset=0, reverse=reverse, position=tokens.get('p'))
+
+    def _get_position_from_instance(self, instance, ordering):
+        """Return the values of every ordering field"""
+        position = []
+        for name in ordering:
+            name = name.lstrip('-')
+            value = instance[name] if isinstance(instance, dict) else getattr(instance, name)
+            # str() of a float reads back as the same float
+            position.append(str(value))
+        return position
+
+
+def _flip(name):
+    return name[1:] if name.startswith('-') else f'-{name}'
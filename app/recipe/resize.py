@@ -0,0 +1,205 @@
+"""Recipe images resized on demand.
+
+A width and format of an image is rendered on its first request, in the
+process pool of recipe.images, and kept in a cache on local disk that
+evicts the least recently used files past RECIPE_RESIZE_CACHE_BYTES.
+Requests for a size being rendered wait for that render instead of
+starting their own, within a process. Cached files are named by the
+image name, width and format, so a new upload never hits a stale file.
+"""
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, features
+
+from recipe import images
+
+# ?fmt= -> (Pillow format, content type, save options)
+FORMATS = OrderedDict([
+    ('jpeg', ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True})),
+    ('webp', ('WEBP', 'image/webp', {'quality': 80, 'method': 4})),
+    ('png', ('PNG', 'image/png', {'optimize': True})),
+])
+if not features.check('webp'):
+    # Pillow built without libwebp, ?fmt=webp is refused
+    del FORMATS['webp']
+MAX_WIDTH = 2048
+# widths rendered, other requested widths are rounded up to one of them so
+# a client can't fill the pool and the cache with every width there is
+WIDTHS = (160, 320, 480, 640, 960, 1280, 1600, MAX_WIDTH)
+
+_ORIENTATION = 0x0112     # EXIF tag
+
+# how stale a process's view of the cache size may get, other processes
+# fill the same directory
+_RESCAN_SECONDS = 60
+
+_lock = threading.Lock()
+_cache = None
+_inflight = {}      # cache path -> Future of the render in progress
+
+
+def cache_root():
+    default = os.path.join(os.path.dirname(settings.MEDIA_ROOT.rstrip('/')), 'resized')
+    return getattr(settings, 'RECIPE_RESIZE_CACHE_DIR', default)
+
+
+def max_cache_bytes():
+    return getattr(settings, 'RECIPE_RESIZE_CACHE_BYTES', 512 * 1024 * 1024)
+
+
+def widths():
+    return tuple(sorted(getattr(settings, 'RECIPE_RESIZE_WIDTHS', WIDTHS)))
+
+
+def allowed_width(width):
+    """Return the smallest rendered width at least width, or the largest"""
+    allowed = widths()
+    return next((w for w in allowed if w >= width), allowed[-1])
+
+
+def image_version(name):
+    """Return a short token identifying the image stored at name"""
+    return hashlib.sha1(name.encode()).hexdigest()[:12]
+
+
+def render_resized(path, width, fmt):
+    """Return the image at path scaled down to width, encoded as fmt.
+    Runs in the worker processes, so it only touches Pillow.
+    """
+    image = Image.open(path)
+    # phone photos are stored sideways, with an EXIF orientation to turn them
+    sideways = image.getexif().get(_ORIENTATION, 1) in (5, 6, 7, 8)
+    upright_width, upright_height = image.size[::-1] if sideways else image.size
+    height = max(1, round(upright_height * width / upright_width))
+    if upright_width > width:
+        # JPEGs decode straight at a fraction of their size
+        image.draft('RGB', (height, width) if sideways else (width, height))
+    image = ImageOps.exif_transpose(image)
+    if upright_width > width:
+        image = image.resize((width, height), Image.LANCZOS)
+    pillow_format, _, options = FORMATS[fmt]
+    if pillow_format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+        alpha = pillow_format != 'JPEG' and (
+            'A' in image.mode or 'transparency' in image.info)
+        image = image.convert('RGBA' if alpha else 'RGB')
+    out = io.BytesIO()
+    image.save(out, format=pillow_format, **options)
+    return out.getvalue()
+
+
+class DiskCache:
+    """Files under root, the least recently used evicted past max_bytes.
+    Hits refresh a file's mtime, which orders eviction across processes.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None     # path -> size, least recently used first
+        self.size = 0
+        self.scanned = 0
+
+    def path(self, key, ext):
+        return os.path.join(self.root, key[:2], f'{key}.{ext}')
+
+    def get(self, path):
+        """Return whether path is cached, marking it recently used"""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            if self.entries is not None and path in self.entries:
+                self.entries.move_to_end(path)
+        return True
+
+    def put(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        with self.lock:
+            if self.entries is None or time.monotonic() - self.scanned > _RESCAN_SECONDS:
+                self._scan()
+            self.size += len(data) - self.entries.pop(path, 0)
+            self.entries[path] = len(data)
+            if self.size > self.max_bytes:
+                self._scan()
+                self._evict()
+
+    def _scan(self):
+        found = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue    # evicted by another process
+                found.append((stat.st_mtime, path, stat.st_size))
+        found.sort()
+        self.entries = OrderedDict((path, size) for _, path, size in found)
+        self.size = sum(self.entries.values())
+        self.scanned = time.monotonic()
+
+    def _evict(self):
+        # down to 90%, so a full cache doesn't rescan on every put
+        while self.entries and self.size > self.max_bytes * 0.9:
+            path, size = self.entries.popitem(last=False)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+def get_cache():
+    global _cache
+    root, max_bytes = cache_root(), max_cache_bytes()
+    with _lock:
+        if _cache is None or (_cache.root, _cache.max_bytes) != (root, max_bytes):
+            _cache = DiskCache(root, max_bytes)
+        return _cache
+
+
+def resized(name, width, fmt):
+    """Return the path of the image stored at name resized to width as
+    fmt, rendering it unless it is cached or already being rendered
+    """
+    cache = get_cache()
+    key = hashlib.sha256(f'{name}:{width}:{fmt}'.encode()).hexdigest()
+    path = cache.path(key, fmt)
+    if cache.get(path):
+        return path
+    with _lock:
+        future = _inflight.get(path)
+        rendering = future is None
+        if rendering:
+            future = _inflight[path] = Future()
+    if rendering:
+        try:
+            data = images.submit(
+                render_resized, default_storage.path(name), width, fmt
+            ).result()
+            cache.put(path, data)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(path)
+        finally:
+            with _lock:
+                del _inflight[path]
+    return future.result()
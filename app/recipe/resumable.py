@@ -0,0 +1,246 @@
+"""Resumable recipe image uploads.
+
+A session is a directory on local disk holding a JSON manifest and one
+file per received byte range, named by its start offset. Clients PUT
+ranges in any order and may retry them; GET reports the ranges held so an
+interrupted client resumes from the first gap. Finalizing concatenates the
+parts in the kernel (copy_file_range, else sendfile) into one file, which
+is then moved, not copied, into the recipe's image storage path.
+
+Sessions live under RECIPE_UPLOAD_SESSION_DIR, one directory per user,
+by default next to MEDIA_ROOT so it is never served and the final move
+stays a rename. Abandoned sessions are removed after
+RECIPE_UPLOAD_SESSION_TTL seconds. Starting an upload replaces any earlier
+one of the same recipe, and a user may hold at most
+RECIPE_UPLOAD_SESSIONS_PER_USER sessions reserving no more than
+RECIPE_UPLOAD_BYTES_PER_USER bytes between them, so that the disk can't be
+filled by opening sessions faster than they expire.
+"""
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+
+from recipe import uploads
+
+_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+_COPY_BLOCK = 64 * 1024
+
+
+class TooManyUploads(APIException):
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    default_detail = 'Too many uploads are in progress.'
+    default_code = 'too_many_uploads'
+
+
+def session_root():
+    default = os.path.join(os.path.dirname(settings.MEDIA_ROOT.rstrip('/')), 'upload-sessions')
+    return getattr(settings, 'RECIPE_UPLOAD_SESSION_DIR', default)
+
+
+def parse_content_range(header, size):
+    """Return (start, end) exclusive from a 'bytes start-last/size' header"""
+    match = _RANGE_RE.match(header or '')
+    if not match:
+        raise ValidationError({'Content-Range': ['Expected "bytes <start>-<end>/<size>".']})
+    start, last, total = map(int, match.groups())
+    if total != size or start > last or last >= size:
+        raise ValidationError({'Content-Range': [f'Range must lie within the {size} bytes.']})
+    return start, last + 1
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    """Append count bytes of src from offset to dst without reading them
+    into Python, where the kernel allows it
+    """
+    while count:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, count, offset_src=offset)
+        except (AttributeError, OSError):
+            copied = os.sendfile(dst_fd, src_fd, offset, count)
+        if not copied:
+            raise OSError('upload part ended early')
+        offset += copied
+        count -= copied
+
+
+class SessionFile(File):
+    """The assembled upload. FileSystemStorage moves files that expose
+    temporary_file_path instead of copying them.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class UploadSession:
+    """One resumable upload of a recipe image."""
+
+    def __init__(self, upload_id, manifest):
+        self.id = upload_id
+        self.manifest = manifest
+        self.path = os.path.join(session_root(), str(manifest['user_id']), upload_id)
+
+    @property
+    def size(self):
+        return self.manifest['size']
+
+    @classmethod
+    def create(cls, user_id, recipe_id, size, filename):
+        purge_expired()
+        if size > uploads.max_image_bytes():
+            raise uploads.too_large()
+        held = []
+        for session in cls.open_sessions(user_id):
+            if session.manifest['recipe_id'] == recipe_id:
+                session.delete()    # a restarted upload replaces the earlier one
+            else:
+                held.append(session.size)
+        if len(held) >= getattr(settings, 'RECIPE_UPLOAD_SESSIONS_PER_USER', 4):
+            raise TooManyUploads()
+        # a session may grow to its declared size, so that is what it holds
+        limit = getattr(settings, 'RECIPE_UPLOAD_BYTES_PER_USER', 4 * uploads.max_image_bytes())
+        if sum(held) + size > limit:
+            raise TooManyUploads(f'Uploads in progress are limited to {limit} bytes.')
+        session = cls(uuid.uuid4().hex, {
+            'user_id': user_id, 'recipe_id': recipe_id, 'size': size,
+            'filename': filename, 'created': time.time(),
+        })
+        os.makedirs(session.path)
+        with open(os.path.join(session.path, 'manifest.json'), 'w') as f:
+            json.dump(session.manifest, f)
+        return session
+
+    @classmethod
+    def load(cls, upload_id, user_id, recipe_id):
+        """Return the user's session for recipe_id, or raise NotFound"""
+        manifest = _read_manifest(os.path.join(session_root(), str(user_id), upload_id))
+        if manifest is None or (manifest['user_id'], manifest['recipe_id']) != (user_id, recipe_id):
+            raise NotFound('Unknown upload.')
+        return cls(upload_id, manifest)
+
+    @classmethod
+    def open_sessions(cls, user_id):
+        """Return the user's sessions"""
+        root = os.path.join(session_root(), str(user_id))
+        sessions = []
+        for upload_id in _listdir(root):
+            manifest = _read_manifest(os.path.join(root, upload_id))
+            if manifest is not None:
+                sessions.append(cls(upload_id, manifest))
+        return sessions
+
+    def parts(self):
+        """Return [(start, length, path)] of the stored parts by offset"""
+        found = []
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.part'):
+                path = os.path.join(self.path, name)
+                found.append((int(name[:-5]), os.path.getsize(path), path))
+        return found
+
+    def ranges(self):
+        """Return the received byte ranges as merged [start, end) pairs"""
+        merged = []
+        for start, length, _ in self.parts():
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], start + length)
+            elif length:
+                merged.append([start, start + length])
+        return merged
+
+    def write(self, start, end, stream):
+        """Store the bytes start..end read from stream. A dropped
+        connection keeps whatever arrived, so the client can resume it.
+        """
+        temp = os.path.join(self.path, f'{start:020d}.{uuid.uuid4().hex}.tmp')
+        received = 0
+        with open(temp, 'wb') as f:
+            while received < end - start:
+                block = stream.read(min(_COPY_BLOCK, end - start - received))
+                if not block:
+                    break
+                f.write(block)
+                received += len(block)
+        part = os.path.join(self.path, f'{start:020d}.part')
+        if received and (not os.path.exists(part) or os.path.getsize(part) <= received):
+            os.replace(temp, part)
+        else:
+            os.remove(temp)
+        return received
+
+    def assemble(self):
+        """Concatenate the parts into one file, returning its path"""
+        if self.ranges() != [[0, self.size]]:
+            raise ValidationError({'detail': 'The upload is incomplete.'})
+        target = os.path.join(self.path, 'assembled')
+        position = 0
+        with open(target, 'wb') as out:
+            for start, length, path in self.parts():
+                if start + length <= position:
+                    continue    # a retry fully covered by earlier parts
+                with open(path, 'rb') as part:
+                    skip = position - start
+                    _copy_range(part.fileno(), out.fileno(), skip, length - skip)
+                position = start + length
+        return target
+
+    def finalize(self, recipe):
+        """Assemble the upload, validate it and store it as the recipe image"""
+        target = self.assemble()
+        with open(target, 'rb') as f:
+            uploads.check_image_header(f.read(uploads.max_header_bytes()))
+            f.seek(0)
+            recipe.image.save(self.manifest['filename'], SessionFile(f), save=True)
+        self.delete()
+
+    def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def as_dict(self):
+        ranges = self.ranges()
+        return {
+            'id': self.id,
+            'size': self.size,
+            'ranges': ranges,
+            # where a client resumes a sequential upload
+            'offset': ranges[0][1] if ranges and ranges[0][0] == 0 else 0,
+        }
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _read_manifest(path):
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def purge_expired():
+    """Remove sessions older than RECIPE_UPLOAD_SESSION_TTL"""
+    root = session_root()
+    cutoff = time.time() - getattr(settings, 'RECIPE_UPLOAD_SESSION_TTL', 24 * 3600)
+    for user_dir in _listdir(root):
+        user_path = os.path.join(root, user_dir)
+        for name in _listdir(user_path):
+            path = os.path.join(user_path, name)
+            try:
+                expired = os.path.getmtime(path) < cutoff
+            except OSError:
+                continue    # removed meanwhile
+            if expired:
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,128 @@
+"""Ranked search over recipe titles.
+
+On PostgreSQL titles are matched with full text search (GIN index on the
+title tsvector) or trigram similarity (pg_trgm GIN index), ranked by the sum
+of both scores. Other databases, i.e. the SQLite test runs, fall back to a
+per-user in-memory inverted index, tagged with the user's collection version
+and kept current by recipe.signals like recipe.bitmaps.
+"""
+import re
+from collections import defaultdict
+
+from django.contrib.postgres.search import (
+    SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+)
+from django.db import connection
+from django.db.models import Case, FloatField, IntegerField, Q, Value, When
+from django.db.models.functions import Cast
+
+from core.models import Recipe
+from recipe import versions
+
+# must match the expression of the GIN index in core migration 0009
+SEARCH_CONFIG = 'english'
+
+# Postgres ranks are real, whose text form needn't read back as the same
+# value, so they are scaled to integers before going into page cursors
+RANK_SCALE = 1000000
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Split text into lower case word tokens"""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def search(queryset, user_id, query):
+    """Filter queryset to recipes matching query, annotated with search_rank"""
+    if connection.vendor == 'postgresql':
+        return _postgres_search(queryset, query)
+    return _fallback_search(queryset, user_id, query)
+
+
+def _postgres_search(queryset, query):
+    vector = SearchVector('title', config=SEARCH_CONFIG)
+    search_query = SearchQuery(query, config=SEARCH_CONFIG)
+    return queryset.annotate(
+        search_vector=vector,
+        search_rank=Cast(
+            (SearchRank(vector, search_query) + TrigramSimilarity('title', query)) * RANK_SCALE,
+            IntegerField()
+        ),
+    ).filter(
+        Q(search_vector=search_query) | Q(title__trigram_similar=query)
+    )
+
+
+def _fallback_search(queryset, user_id, query):
+    ranks = get_index(user_id).search(query)
+    return queryset.filter(id__in=list(ranks)).annotate(
+        search_rank=Case(
+            *[When(id=recipe_id, then=Value(rank)) for recipe_id, rank in ranks.items()],
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+    )
+
+
+class TitleIndex:
+    """Inverted index from title tokens to one user's recipe ids."""
+
+    def __init__(self):
+        self.postings = defaultdict(set)    # token -> recipe ids
+        self.titles = {}                    # recipe id -> tokens
+
+    def add(self, recipe_id, title):
+        self.remove(recipe_id)
+        tokens = self.titles[recipe_id] = set(tokenize(title))
+        for token in tokens:
+            self.postings[token].add(recipe_id)
+
+    def remove(self, recipe_id):
+        for token in self.titles.pop(recipe_id, ()):
+            self.postings[token].discard(recipe_id)
+            if not self.postings[token]:
+                del self.postings[token]
+
+    def search(self, query):
+        """Return {recipe id: rank}. A whole token match scores 1 and a
+        prefix match 0.5, summed over the query tokens.
+        """
+        ranks = defaultdict(float)
+        for term in set(tokenize(query)):
+            matched = set(self.postings.get(term, ()))
+            for recipe_id in matched:
+                ranks[recipe_id] += 1
+            for token, recipe_ids in list(self.postings.items()):
+                if token != term and token.startswith(term):
+                    for recipe_id in recipe_ids - matched:
+                        ranks[recipe_id] += 0.5
+                        matched.add(recipe_id)
+        return ranks
+
+    @classmethod
+    def build(cls, user_id):
+        index = cls()
+        for recipe_id, title in Recipe.objects.filter(
+                user_id=user_id).values_list('id', 'title'):
+            index.add(recipe_id, title)
+        return index
+
+
+_indexes = versions.IndexCache(TitleIndex, 'RECIPE_SEARCH_INDEX_USERS', follows_writes=True)
+
+
+def get_index(user_id):
+    """Return the user's title index, (re)building it if needed"""
+    return _indexes.get(user_id)
+
+
+def update(user_id, func, *args):
+    """Apply func to the user's title index once the transaction commits"""
+    _indexes.update(user_id, func, *args)
+
+
+def clear():
+    """Drop every title index"""
+    _indexes.clear()
@@ -1,26 +1,75 @@
+from collections import OrderedDict, defaultdict
+
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_save
 from rest_framework import serializers
-from core.models import Tag, Ingredient, Recipe
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.utils.serializer_helpers import ReturnList
+from core.models import Tag, Ingredient, Recipe, normalize_name
+from recipe import images, resize
+
+
+def _split_param(value):
+    return {name.strip() for name in value.split(',') if name.strip()} if value else set()
+
+
+def requested_fields(request, fields):
+    """Return the subset of fields asked for with ?fields= and ?omit=.
+    Only read requests are trimmed so writes always see every field.
+    """
+    if request is None or request.method not in SAFE_METHODS:
+        return tuple(fields)
+    only = _split_param(request.query_params.get('fields'))
+    omit = _split_param(request.query_params.get('omit'))
+    return tuple(
+        name for name in fields if (not only or name in only) and name not in omit
+    )
+
+
+class SparseFieldsMixin:
+    """Serialize only the fields requested with ?fields= / ?omit="""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        keep = requested_fields(self.context.get('request'), self.Meta.fields)
+        for name in set(self.fields) - set(keep):
+            self.fields.pop(name)
+
+
+class NormalizedNameMixin:
+    """Store names stripped, with inner whitespace collapsed"""
 
+    def validate_name(self, value):
+        return normalize_name(value)
 
-class TagSerializer(serializers.ModelSerializer):
+
+class TagSerializer(SparseFieldsMixin, NormalizedNameMixin, serializers.ModelSerializer):
     """Serializer for Tag objects"""
 
     class Meta:
         model = Tag
-        fields = ('id', 'name')
-        ready_only_fields = ('id', )
+        fields = ('id', 'name', 'recipe_count')
+        read_only_fields = ('id', 'recipe_count')
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(SparseFieldsMixin, NormalizedNameMixin,
+                           serializers.ModelSerializer):
     """Serializer for Ingredient objects"""
 
     class Meta:
         model = Ingredient
-        fields = ('id', 'name')
-        read_only_fields = ('id', )
+        fields = ('id', 'name', 'recipe_count')
+        read_only_fields = ('id', 'recipe_count')
+
+
+class ImageVariantsMixin:
+    """Expose the URLs of the resized variants of the recipe image"""
+
+    def get_image_variants(self, obj):
+        return images.variant_urls(obj.image.name, self.context.get('request'))
 
 
-class RecipeSerializer(serializers.ModelSerializer):
+class RecipeSerializer(SparseFieldsMixin, ImageVariantsMixin, serializers.ModelSerializer):
     """Serializer for Recipe objects"""
     ingredients = serializers.PrimaryKeyRelatedField(
         many=True,
@@ -30,23 +79,203 @@ class RecipeSerializer(serializers.ModelSerializer):
         many=True,
         queryset=Tag.objects.all()
     )
+    image_variants = serializers.SerializerMethodField()
+    # model columns read by fields that aren't columns themselves
+    field_columns = {'image_variants': 'image'}
 
     class Meta:
         model = Recipe
-        fields = ('id', 'title', 'ingredients', 'tags', 'time_minutes', 'price', 'link')
+        fields = (
+            'id', 'title', 'ingredients', 'tags', 'time_minutes', 'price', 'link',
+            'image_variants',
+        )
         read_only_fields = ('id', )
 
 
+class RecipeValuesSerializer:
+    """Read-only fast path producing the same list payload as
+    RecipeSerializer from values() rows, without instantiating models.
+    Related ids are read straight from the through tables, ordered by id.
+    """
+    RELATIONS = ('ingredients', 'tags')
+    # the values() a row needs for every field
+    COLUMNS = ('id', 'title', 'time_minutes', 'price', 'link', 'image')
+
+    class Meta:
+        fields = RecipeSerializer.Meta.fields
+
+    price_field = serializers.DecimalField(max_digits=5, decimal_places=2)
+
+    def __init__(self, rows, many=True, context=None):
+        self.rows = list(rows)
+        self.context = context or {}
+
+    @staticmethod
+    def related_ids(field, recipe_ids):
+        """Return {recipe id: [related ids]} in one query"""
+        through = getattr(Recipe, field).through
+        column = through._meta.get_field(field[:-1]).attname
+        ids = defaultdict(list)
+        rows = through.objects.filter(
+            recipe_id__in=recipe_ids
+        ).values_list('recipe_id', column).order_by(column)
+        for recipe_id, related_id in rows:
+            ids[recipe_id].append(related_id)
+        return ids
+
+    @property
+    def data(self):
+        fields = requested_fields(self.context.get('request'), self.Meta.fields)
+        recipe_ids = [row['id'] for row in self.rows]
+        related = {
+            field: self.related_ids(field, recipe_ids)
+            for field in self.RELATIONS if field in fields
+        }
+        price = self.price_field.to_representation
+        request = self.context.get('request')
+        data = []
+        for row in self.rows:
+            item = OrderedDict()
+            for name in fields:
+                if name in related:
+                    item[name] = related[name].get(row['id'], [])
+                elif name == 'price':
+                    item[name] = price(row[name])
+                elif name == 'image_variants':
+                    item[name] = images.variant_urls(row['image'], request)
+                else:
+                    item[name] = row[name]
+            data.append(item)
+        return ReturnList(data, serializer=self)
+
+
+class PantrySerializer(serializers.Serializer):
+    """Parameters of a "what can I cook" query"""
+    ingredients = serializers.ListField(child=serializers.IntegerField())
+    max_missing = serializers.IntegerField(min_value=0, max_value=10, default=0)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+
+class ShoppingListSerializer(serializers.Serializer):
+    """Recipes to build a shopping list for"""
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=100
+    )
+
+
+class UploadSessionSerializer(serializers.Serializer):
+    """Start of a resumable image upload"""
+    size = serializers.IntegerField(min_value=1)
+    filename = serializers.RegexField(r'^[^/\\]+\.\w+$', max_length=100)
+
+
+class ResizeSerializer(serializers.Serializer):
+    """Size and format of a resized recipe image"""
+    w = serializers.IntegerField(min_value=1, max_value=resize.MAX_WIDTH)
+    fmt = serializers.ChoiceField(choices=list(resize.FORMATS), default='jpeg')
+    v = serializers.CharField(required=False)
+
+
+class RecipeBulkListSerializer(serializers.ListSerializer):
+    """Validate and insert many recipes with a constant number of queries"""
+    RELATIONS = (('ingredients', Ingredient), ('tags', Tag))
+
+    def to_internal_value(self, data):
+        """Validate every item and report errors for all of them at once"""
+        if not isinstance(data, list):
+            raise serializers.ValidationError('Expected a list of items.')
+        attrs, errors = [], []
+        for item in data:
+            try:
+                attrs.append(self.child.run_validation(item))
+                errors.append({})
+            except serializers.ValidationError as exc:
+                attrs.append({})
+                errors.append(exc.detail)
+        self._check_related_ids(attrs, errors)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def _check_related_ids(self, attrs, errors):
+        """Check every referenced tag/ingredient with one query per model"""
+        user = self.context['request'].user
+        for field, model in self.RELATIONS:
+            wanted = {pk for item in attrs for pk in item.get(field, ())}
+            found = set(model.objects.filter(
+                user=user, id__in=wanted
+            ).values_list('id', flat=True))
+            for item, item_errors in zip(attrs, errors):
+                missing = [pk for pk in item.get(field, ()) if pk not in found]
+                if missing:
+                    item_errors[field] = [
+                        f'Invalid pk "{pk}" - object does not exist.' for pk in missing
+                    ]
+
+    def create(self, validated_data):
+        relations = [
+            {field: item.pop(field, []) for field, _ in self.RELATIONS}
+            for item in validated_data
+        ]
+        with transaction.atomic():
+            recipes = [Recipe(**item) for item in validated_data]
+            if connection.features.can_return_ids_from_bulk_insert:
+                Recipe.objects.bulk_create(recipes)
+            else:
+                for recipe in recipes:
+                    recipe.save()
+            for field, model in self.RELATIONS:
+                through = getattr(Recipe, field).through
+                column = through._meta.get_field(field[:-1]).attname
+                through.objects.bulk_create(
+                    through(recipe_id=recipe.id, **{column: pk})
+                    for recipe, related in zip(recipes, relations)
+                    for pk in dict.fromkeys(related[field])
+                )
+            self._send_signals(recipes, relations)
+        return recipes
+
+    def _send_signals(self, recipes, relations):
+        """bulk_create skips model signals, replay them for the receivers in
+        recipe.signals: a post_save per recipe and a reverse m2m post_add
+        per tag/ingredient.
+        """
+        for recipe in recipes:
+            post_save.send(sender=Recipe, instance=recipe, created=True,
+                           update_fields=None, raw=False, using=recipe._state.db)
+        for field, model in self.RELATIONS:
+            recipe_ids = defaultdict(set)
+            for recipe, related in zip(recipes, relations):
+                for pk in related[field]:
+                    recipe_ids[pk].add(recipe.id)
+            for related_obj in model.objects.filter(id__in=recipe_ids):
+                m2m_changed.send(
+                    sender=getattr(Recipe, field).through, instance=related_obj,
+                    action='post_add', reverse=True, model=Recipe,
+                    pk_set=recipe_ids[related_obj.id], using=related_obj._state.db,
+                )
+
+
+class RecipeBulkSerializer(RecipeSerializer):
+    """Serializer for one item of a bulk recipe creation"""
+    ingredients = serializers.ListField(child=serializers.IntegerField(), required=False)
+    tags = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    class Meta(RecipeSerializer.Meta):
+        list_serializer_class = RecipeBulkListSerializer
+
+
 class RecipeDetailSerializer(RecipeSerializer):
     """Serialize a recipe detail"""
     ingredients = IngredientSerializer(many=True, read_only=True)
     tags = TagSerializer(many=True, read_only=True)
 
 
-class RecipeImageSerializer(serializers.ModelSerializer):
+class RecipeImageSerializer(ImageVariantsMixin, serializers.ModelSerializer):
     """Serializer for uploading an image to a recipe"""
+    image_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipe
-        fields = ('id', 'image')
+        fields = ('id', 'image', 'image_variants')
         read_only_fields = ('id', )
\ No newline at end of file
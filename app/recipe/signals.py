@@ -0,0 +1,187 @@
+from functools import partial
+from operator import methodcaller
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete, pre_save,
+)
+from django.dispatch import receiver
+
+from core.models import Tag, Ingredient, Recipe, StoredFile
+from recipe import bitmaps, images, search, similar, versions
+
+
+# per-user in-memory indexes sharing the add/remove/clear_recipe/drop_* methods
+INDEXES = (bitmaps, similar)
+
+
+def _update_indexes(user_id, method, *args):
+    """Apply a write to the indexes once it commits. Called before the
+    write bumps the version, so the indexes are current at that version.
+    """
+    for module in INDEXES:
+        module.update(user_id, methodcaller(method, *args))
+
+
+def _recipe_attr_changed(field, instance, action, reverse, pk_set):
+    """Mirror an M2M change between recipes and tags/ingredients"""
+    user_id = instance.user_id
+    if action in ('post_add', 'post_remove'):
+        method = 'add' if action == 'post_add' else 'remove'
+        for pk in pk_set:
+            # forward: recipe.tags.add(*tags), reverse: tag.recipe_set.add(*recipes)
+            attr_id, recipe_id = (instance.pk, pk) if reverse else (pk, instance.pk)
+            _update_indexes(user_id, method, field, attr_id, recipe_id)
+    elif action == 'post_clear':
+        if reverse:
+            _update_indexes(user_id, 'drop_attr', field, instance.pk)
+        else:
+            _update_indexes(user_id, 'clear_recipe', field, instance.pk)
+    if action.startswith('post_'):
+        versions.bump(user_id)
+    _update_recipe_counts(field, instance, action, reverse, pk_set)
+
+
+def _update_recipe_counts(field, instance, action, reverse, pk_set):
+    """Keep recipe_count of the tags/ingredients in step with their links.
+    Adds only report new links, removals are counted before the links go,
+    as pk_set may name ids that were never linked.
+    """
+    through = getattr(Recipe, field).through
+    model = Recipe._meta.get_field(field).remote_field.model
+    column = f'{model._meta.model_name}_id'
+    if action == 'post_add':
+        if reverse:
+            model.objects.filter(pk=instance.pk).update(
+                recipe_count=F('recipe_count') + len(pk_set)
+            )
+        else:
+            model.objects.filter(pk__in=pk_set).update(recipe_count=F('recipe_count') + 1)
+    elif action in ('pre_remove', 'pre_clear'):
+        if reverse:
+            if action == 'pre_clear':
+                model.objects.filter(pk=instance.pk).update(recipe_count=0)
+                return
+            removed = through.objects.filter(
+                **{column: instance.pk, 'recipe_id__in': pk_set}
+            ).count()
+            if removed:
+                model.objects.filter(pk=instance.pk).update(
+                    recipe_count=F('recipe_count') - removed
+                )
+        else:
+            links = through.objects.filter(recipe_id=instance.pk)
+            if action == 'pre_remove':
+                links = links.filter(**{f'{column}__in': pk_set})
+            model.objects.filter(pk__in=links.values(column)).update(
+                recipe_count=F('recipe_count') - 1
+            )
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    _recipe_attr_changed('tags', instance, action, reverse, pk_set)
+
+
+@receiver(m2m_changed, sender=Recipe.ingredients.through)
+def recipe_ingredients_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    _recipe_attr_changed('ingredients', instance, action, reverse, pk_set)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+def user_collection_changed(sender, instance, **kwargs):
+    versions.bump(instance.user_id)
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+def recipe_attr_deleted(sender, instance, **kwargs):
+    # the cascade deletes the links without sending m2m_changed
+    field = 'tags' if sender is Tag else 'ingredients'
+    _update_indexes(instance.user_id, 'drop_attr', field, instance.pk)
+    versions.bump(instance.user_id)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, **kwargs):
+    search.update(instance.user_id, search.TitleIndex.add, instance.pk, instance.title)
+    versions.bump(instance.user_id)
+
+
+@receiver(pre_delete, sender=Recipe)
+def recipe_deleting(sender, instance, **kwargs):
+    # the cascade deletes the links without sending m2m_changed
+    for field in ('tags', 'ingredients'):
+        _update_recipe_counts(field, instance, 'pre_clear', False, None)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    _update_indexes(instance.user_id, 'drop_recipe', instance.pk)
+    search.update(instance.user_id, search.TitleIndex.remove, instance.pk)
+    versions.bump(instance.user_id)
+    if _image_name(instance):
+        _release_image(_image_name(instance))
+
+
+def _image_name(instance):
+    """Return the loaded image name of a recipe, None if deferred"""
+    if 'image' not in instance.__dict__:
+        return None
+    value = instance.__dict__['image']
+    return getattr(value, 'name', value) or ''
+
+
+def _collect_image(name):
+    """Delete an image and its variants once nothing refers to it"""
+    # a save of the same bytes waits on the locked row until the file is gone
+    with transaction.atomic():
+        if StoredFile.objects.collect(name):
+            Recipe._meta.get_field('image').storage.delete(name)
+            images.delete_variants(name)
+
+
+def _release_image(name):
+    StoredFile.objects.release(name)
+    transaction.on_commit(partial(_collect_image, name))
+
+
+def release_images(names):
+    """Release the references saving the image files counted"""
+    for name in names:
+        _release_image(name)
+
+
+@receiver(pre_save, sender=Recipe)
+def recipe_saving(sender, instance, update_fields=None, **kwargs):
+    # the image name is final only after saving, remember the stored one
+    if instance._state.adding:
+        instance._stored_image = ''
+    elif _image_name(instance) is not None and (
+            update_fields is None or 'image' in update_fields):
+        instance._stored_image = Recipe.objects.filter(
+            pk=instance.pk).values_list('image', flat=True).first() or ''
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_image_saved(sender, instance, created, **kwargs):
+    """Count the references to recipe images as they change"""
+    # bulk_create replays post_save without a pre_save
+    previous = instance.__dict__.pop('_stored_image', '' if created else None)
+    name = _image_name(instance)
+    # saving files counted references, the one to name becomes this recipe's
+    unused = instance.__dict__.pop('_taken_images', [])
+    taken = bool(name) and name in unused
+    if taken:
+        unused.remove(name)
+    release_images(unused)
+    if previous is None or name is None or previous == name:
+        if taken:
+            _release_image(name)
+        return
+    if name and not taken:
+        StoredFile.objects.acquire(name)
+    if previous:
+        _release_image(previous)
@@ -0,0 +1,166 @@
+"""Per-user in-memory MinHash/LSH index of recipes by tags and ingredients.
+
+Each recipe's set of tags and ingredients is summarized by a MinHash
+signature, whose positions agree between two recipes with probability equal
+to the Jaccard similarity of their sets. Signatures are cut into bands and
+recipes sharing any band land in the same bucket, so a lookup only scores
+the recipes in its buckets instead of the whole library. Candidates are
+re-ranked by their exact Jaccard similarity. The index is process local,
+kept current by the same committed M2M changes as recipe.bitmaps and
+rebuilt like it when other processes move the collection version.
+"""
+import random
+from collections import defaultdict
+from functools import lru_cache
+
+from core.models import Recipe
+from recipe import versions
+
+FIELDS = ('tags', 'ingredients')
+
+# 16 bands of 4 rows: pairs above ~0.5 similarity share a bucket with
+# high probability, pairs below ~0.3 rarely do
+BANDS = 16
+ROWS = 4
+NUM_PERM = BANDS * ROWS
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(4242)      # fixed, signatures must agree across builds
+_PERMUTATIONS = [
+    (_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)
+]
+
+
+def _element(field, attr_id):
+    # tags and ingredients share one integer space
+    return attr_id * 2 + FIELDS.index(field)
+
+
+@lru_cache(maxsize=65536)
+def _element_hashes(element):
+    return tuple((a * element + b) % _PRIME for a, b in _PERMUTATIONS)
+
+
+def signature(elements):
+    """Return the MinHash signature of a non-empty set of elements"""
+    return tuple(map(min, zip(*map(_element_hashes, elements))))
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+class SimilarityIndex:
+    """MinHash signatures and LSH buckets of one user's recipes."""
+
+    def __init__(self):
+        self.elements = defaultdict(set)    # recipe id -> tag/ingredient elements
+        self.signatures = {}                # recipe id -> signature
+        self.buckets = defaultdict(set)     # (band, band of signature) -> recipe ids
+
+    def _band_keys(self, recipe_id):
+        sig = self.signatures.get(recipe_id)
+        if sig is None:
+            return []
+        return [(band, sig[band * ROWS:(band + 1) * ROWS]) for band in range(BANDS)]
+
+    def _unbucket(self, recipe_id):
+        for key in self._band_keys(recipe_id):
+            self.buckets[key].discard(recipe_id)
+            if not self.buckets[key]:
+                del self.buckets[key]
+        self.signatures.pop(recipe_id, None)
+
+    def _rehash(self, recipe_id):
+        """Recompute a recipe's signature, MinHash can't remove elements"""
+        self._unbucket(recipe_id)
+        elements = self.elements.get(recipe_id)
+        if not elements:
+            self.elements.pop(recipe_id, None)
+            return
+        self.signatures[recipe_id] = signature(elements)
+        for key in self._band_keys(recipe_id):
+            self.buckets[key].add(recipe_id)
+
+    def add(self, field, attr_id, recipe_id):
+        self.elements[recipe_id].add(_element(field, attr_id))
+        self._rehash(recipe_id)
+
+    def remove(self, field, attr_id, recipe_id):
+        if recipe_id in self.elements:
+            self.elements[recipe_id].discard(_element(field, attr_id))
+            self._rehash(recipe_id)
+
+    def clear_recipe(self, field, recipe_id):
+        if recipe_id in self.elements:
+            offset = FIELDS.index(field)
+            self.elements[recipe_id] = {
+                element for element in self.elements[recipe_id] if element % 2 != offset
+            }
+            self._rehash(recipe_id)
+
+    def drop_recipe(self, recipe_id):
+        self._unbucket(recipe_id)
+        self.elements.pop(recipe_id, None)
+
+    def drop_attr(self, field, attr_id):
+        element = _element(field, attr_id)
+        for recipe_id in [pk for pk, elements in self.elements.items() if element in elements]:
+            self.elements[recipe_id].discard(element)
+            self._rehash(recipe_id)
+
+    def candidates(self, recipe_id):
+        """Return the recipes sharing at least one band with recipe_id"""
+        found = set()
+        for key in self._band_keys(recipe_id):
+            found |= self.buckets.get(key, set())
+        found.discard(recipe_id)
+        return found
+
+    def similar(self, recipe_id, limit=10):
+        """Return [(recipe id, Jaccard similarity)] of the most similar
+        recipes among the LSH candidates, most similar first
+        """
+        elements = self.elements.get(recipe_id, set())
+        scored = [
+            (pk, jaccard(elements, self.elements.get(pk, set())))
+            for pk in self.candidates(recipe_id)
+        ]
+        scored.sort(key=lambda item: (-item[1], -item[0]))
+        return scored[:limit]
+
+    @classmethod
+    def build(cls, user_id):
+        """Load the index for a user from the M2M tables"""
+        index = cls()
+        for field in FIELDS:
+            through = getattr(Recipe, field).through
+            attr_column = through._meta.get_field(field[:-1]).attname
+            rows = through.objects.filter(
+                recipe__user_id=user_id
+            ).values_list(attr_column, 'recipe_id')
+            for attr_id, recipe_id in rows:
+                index.elements[recipe_id].add(_element(field, attr_id))
+        for recipe_id in list(index.elements):
+            index._rehash(recipe_id)
+        return index
+
+
+_indexes = versions.IndexCache(
+    SimilarityIndex, 'RECIPE_SIMILAR_INDEX_USERS', follows_writes=True
+)
+
+
+def get_index(user_id):
+    """Return the user's index, (re)building it if needed"""
+    return _indexes.get(user_id)
+
+
+def update(user_id, func, *args):
+    """Apply func to the user's index once the transaction commits"""
+    _indexes.update(user_id, func, *args)
+
+
+def clear():
+    """Drop every index"""
+    _indexes.clear()
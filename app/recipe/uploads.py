@@ -0,0 +1,145 @@
+"""Streaming recipe image uploads.
+
+Uploads are written to a temporary file chunk by chunk and checked as they
+arrive: the Content-Length before anything is read, the magic bytes and
+the dimensions from the image header, and the running size. A bad upload
+is rejected by raising from the upload handler, which stops reading the
+request body right there.
+"""
+import io
+import warnings
+
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from PIL import Image
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.parsers import MultiPartParser
+
+# leading bytes of each accepted format, WEBP also needs 'WEBP' at offset 8
+MAGIC_BYTES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'RIFF', 'WEBP'),
+)
+
+# room for the multipart boundaries and the other form fields
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class FileTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'The uploaded file is too large.'
+    default_code = 'file_too_large'
+
+
+def _limit(name, default):
+    return getattr(settings, name, default)
+
+
+def sniff_format(header):
+    """Return the image format named by the leading bytes, or None"""
+    for magic, image_format in MAGIC_BYTES:
+        if header.startswith(magic):
+            if image_format == 'WEBP' and header[8:12] != b'WEBP':
+                return None
+            return image_format
+    return None
+
+
+def max_header_bytes():
+    return _limit('RECIPE_IMAGE_HEADER_BYTES', 256 * 1024)
+
+
+def max_image_bytes():
+    return _limit('RECIPE_IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+
+
+def too_large():
+    return FileTooLarge({'image': [f'Images are limited to {max_image_bytes()} bytes.']})
+
+
+def check_image_header(header, complete=True):
+    """Validate the format and dimensions of an image from its leading
+    bytes, raising ValidationError. Returns False while more of the header
+    is needed, unless complete says there is no more.
+    Limits: RECIPE_IMAGE_FORMATS, RECIPE_IMAGE_MAX_PIXELS and
+    RECIPE_IMAGE_HEADER_BYTES, the most read looking for the dimensions.
+    """
+    if len(header) < 12 and not complete:
+        return False
+    formats = _limit('RECIPE_IMAGE_FORMATS', ('JPEG', 'PNG', 'GIF', 'WEBP'))
+    if sniff_format(header) not in formats:
+        raise ValidationError({'image': ['Upload a JPEG, PNG, GIF or WEBP image.']})
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            # only parses the header, no pixels are decoded
+            width, height = Image.open(io.BytesIO(header)).size
+    except Image.DecompressionBombError:
+        width = height = None
+    except Exception:
+        if not complete and len(header) < max_header_bytes():
+            return False    # header not all in yet
+        raise ValidationError({'image': ['The image header could not be read.']})
+    max_pixels = _limit('RECIPE_IMAGE_MAX_PIXELS', 40 * 1000 * 1000)
+    if width is None or width * height > max_pixels:
+        raise ValidationError({'image': [f'Images are limited to {max_pixels} pixels.']})
+    return True
+
+
+class ImageUploadHandler(TemporaryFileUploadHandler):
+    """Stream uploaded images to disk, rejecting them from their headers
+    with check_image_header or past RECIPE_IMAGE_MAX_BYTES.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.max_bytes = max_image_bytes()
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > self.max_bytes + MULTIPART_OVERHEAD:
+            raise too_large()
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+        self.header = b''
+        self.checked = False
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_bytes:
+            self._reject(too_large())
+        if not self.checked:
+            self.header += raw_data
+            self._check_header(complete=False)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        if not self.checked:
+            self._check_header(complete=True)
+        return super().file_complete(file_size)
+
+    def _reject(self, exc):
+        self.file.close()
+        raise exc
+
+    def _check_header(self, complete):
+        try:
+            self.checked = check_image_header(self.header, complete)
+        except ValidationError as exc:
+            self._reject(exc)
+        if self.checked:
+            self.header = b''
+
+
+class ImageUploadParser(MultiPartParser):
+    """Multipart parser streaming files through ImageUploadHandler"""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context['request']
+        request.upload_handlers = [ImageUploadHandler(request._request)]
+        return super().parse(stream, media_type, parser_context)
@@ -0,0 +1,158 @@
+"""Per-user version counters for the recipe app collections.
+
+Every write to a user's recipes, tags, ingredients or their M2M links bumps
+the user's counter (see recipe.signals), so list responses can be tagged and
+revalidated without touching the collections themselves. Counters live in
+the RECIPE_CACHE_ALIAS cache, which must be shared between processes.
+
+The counter also tags the process local indexes of IndexCache. Versions
+reached by the committed writes of this process are remembered, so an
+index kept current by those writes needn't be rebuilt for them.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import quote_etag
+
+# versions remembered per user, and users, before the oldest are forgotten
+_OWN_VERSIONS = 1000
+_OWN_USERS = 10000
+
+_lock = threading.Lock()
+_own = OrderedDict()    # user id -> versions moved to by committed writes of this process
+
+
+def _cache():
+    return caches[getattr(settings, 'RECIPE_CACHE_ALIAS', 'default')]
+
+
+def _key(user_id):
+    return f'recipe:version:{user_id}'
+
+
+def _initial():
+    # never hands out a number used before, even after the key was evicted
+    return time.time_ns() // 1000
+
+
+def get_version(user_id):
+    """Return the current version of the user's collections"""
+    cache = _cache()
+    version = cache.get(_key(user_id))
+    if version is None:
+        cache.add(_key(user_id), _initial(), timeout=None)
+        version = cache.get(_key(user_id))
+    return version
+
+
+def _incr(user_id):
+    """Move the counter on, returning the new version if it was counted"""
+    cache = _cache()
+    try:
+        return cache.incr(_key(user_id))
+    except ValueError:
+        cache.add(_key(user_id), _initial(), timeout=None)
+        return None
+
+
+def _committed(user_id, version):
+    versions = (version, _incr(user_id))
+    with _lock:
+        own = _own.setdefault(user_id, set())
+        _own.move_to_end(user_id)
+        own.update(v for v in versions if v is not None)
+        if len(own) > _OWN_VERSIONS:
+            own.difference_update(sorted(own)[:len(own) // 2])
+        while len(_own) > _OWN_USERS:
+            _own.popitem(last=False)
+
+
+def bump(user_id):
+    """Mark the user's collections as changed.
+    The counter moves now and again once the transaction commits, so a
+    reader can't pair the new version with the pre-commit data.
+    """
+    transaction.on_commit(partial(_committed, user_id, _incr(user_id)))
+
+
+def own_writes(user_id, since, until):
+    """Return whether the counter only moved from since to until for
+    writes this process committed
+    """
+    if not 0 < until - since <= _OWN_VERSIONS:
+        return False
+    with _lock:
+        own = _own.get(user_id, ())
+        return all(version in own for version in range(since + 1, until + 1))
+
+
+class IndexCache:
+    """Process local indexes of users' collections, built by
+    index_class.build(user_id, *args) and tagged with the version they
+    were built at.
+    The least recently used are evicted past the limit_setting count.
+
+    A lookup after a write rebuilds the index, unless the cache follows
+    writes: the receivers in recipe.signals then apply the writes of this
+    process with update(), once they commit, and only versions moved by
+    other processes or rolled back transactions rebuild it.
+    """
+
+    def __init__(self, index_class, limit_setting, follows_writes=False):
+        self.index_class = index_class
+        self.limit_setting = limit_setting
+        self.follows_writes = follows_writes
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()    # (user id, *args) -> (version, index)
+
+    def get(self, user_id, *args):
+        """Return the user's index, (re)building it if the user's
+        collections changed since it was built
+        """
+        key = (user_id, *args)
+        version = get_version(user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] == version or self.follows_writes and (
+                    own_writes(user_id, entry[0], version))):
+                self.entries[key] = (version, entry[1])
+                self.entries.move_to_end(key)
+                return entry[1]
+        index = self.index_class.build(user_id, *args)
+        with self.lock:
+            self.entries[key] = (version, index)
+            self.entries.move_to_end(key)
+            limit = getattr(settings, self.limit_setting, 1000)
+            while len(self.entries) > limit:
+                self.entries.popitem(last=False)
+        return index
+
+    def update(self, user_id, func, *args):
+        """Apply func(index, *args) to the user's index once the
+        transaction commits, if the index has been built by then
+        """
+        transaction.on_commit(partial(self._apply, user_id, func, args))
+
+    def _apply(self, user_id, func, args):
+        with self.lock:
+            entry = self.entries.get((user_id,))
+            if entry is not None:
+                func(entry[1], *args)
+
+    def clear(self):
+        """Drop every index"""
+        with self.lock:
+            self.entries.clear()
+
+
+def etag(request, version):
+    """Return the ETag of a list response at the user's version"""
+    variant = f"{request.get_full_path()}|{request.META.get('HTTP_ACCEPT', '')}"
+    digest = hashlib.md5(variant.encode()).hexdigest()[:16]
+    return quote_etag(f'{request.user.id}-{version}-{digest}')
@@ -1,49 +1,179 @@
+import io
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import (
+    Count, Exists, IntegerField, OuterRef, Prefetch, Subquery
+)
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import viewsets, mixins, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.fields import CharField, ListField
 from rest_framework.response import Response
 from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.views import APIView
+
+from core.models import Tag, Ingredient, Recipe, name_key
+from recipe import (
+    autocomplete, bitmaps, images, media, resize, resumable, serializers, similar, versions
+)
+from recipe import cache as response_cache
+from recipe import search as recipe_search
+from recipe.pagination import RecipeCursorPagination
+from recipe.uploads import ImageUploadParser
+
+
+# files under names that never change content are cached for a year
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
 
-from core.models import Tag, Ingredient, Recipe
-from recipe import serializers
+def _limit_param(request, default=10, maximum=100):
+    """Return ?limit= clamped to 1..maximum"""
+    try:
+        limit = int(request.query_params.get('limit', default))
+    except ValueError:
+        raise ValidationError({'limit': ['A valid integer is required.']})
+    return min(max(limit, 1), maximum)
+
+
+class ConditionalListMixin:
+    """Answer list requests with 304 Not Modified while the user's
+    collections are unchanged, before any queryset is built, and serve
+    repeated lists from the response cache.
+    """
+
+    def list(self, request, *args, **kwargs):
+        version = versions.get_version(request.user.id)
+        etag = versions.etag(request, version)
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        elif response_cache.enabled():
+            data, hit = response_cache.get_or_compute(
+                response_cache.make_key(request, version),
+                lambda: super(ConditionalListMixin, self).list(request, *args, **kwargs).data
+            )
+            response = Response(data)
+            response['X-Cache'] = 'HIT' if hit else 'MISS'
+        else:
+            response = super().list(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
 
 
-class BaseRecipeAttrViewSet(viewsets.GenericViewSet,
+class BaseRecipeAttrViewSet(ConditionalListMixin,
+                            viewsets.GenericViewSet,
                             mixins.ListModelMixin,
                             mixins.CreateModelMixin):
     """Base ViewSet for user owned recipe attributes."""
     authentication_classes = (TokenAuthentication, )
     permission_classes = (IsAuthenticated, )
+    orderings = ('name', '-name', 'recipe_count', '-recipe_count')
+
+    def _int_param(self, name):
+        """Return the integer query parameter name, 0 if it is absent"""
+        try:
+            return int(self.request.query_params.get(name, 0))
+        except ValueError:
+            raise ValidationError({name: ['A valid integer is required.']})
 
     def get_queryset(self):
         """Return objects for the current authenticated user only."""
-        assigned_only = bool(
-            int(self.request.query_params.get('assigned_only', 0))
-        )
-        queryset = self.queryset
-        if assigned_only:
-            queryset = queryset.filter(recipe__isnull=False)
-            # returns tags & ingredients assigned to recipes only
-        return queryset.filter(user=self.request.user).order_by('-name').distinct()
+        assigned_only = bool(self._int_param('assigned_only'))
+        min_recipes = self._int_param('min_recipes')
+        queryset = self.queryset.filter(user=self.request.user)
+        if assigned_only or min_recipes > 0:
+            # returns tags & ingredients assigned to (at least N) recipes only
+            queryset = self._filter_recipe_count(queryset, max(min_recipes, 1))
+        # unknown orderings are ignored, like DRF's OrderingFilter does
+        ordering = self.request.query_params.get('ordering')
+        if ordering not in self.orderings:
+            ordering = '-name'
+        if self.action == 'list':
+            # load only the columns the serializer will output
+            queryset = queryset.only('id', *serializers.requested_fields(
+                self.request, self.get_serializer_class().Meta.fields
+            ))
+        return queryset.order_by(ordering, '-name', 'id')
+
+    def _filter_recipe_count(self, queryset, min_recipes):
+        """Keep objects linked to at least min_recipes recipes.
+        Both cases are correlated subqueries on the (attr_id, recipe_id)
+        through table index, no join over the whole table and no DISTINCT.
+        """
+        through = getattr(Recipe, self.recipe_field).through
+        column = through._meta.get_field(self.recipe_field[:-1]).attname
+        links = through.objects.filter(**{column: OuterRef('pk')})
+        if min_recipes == 1:
+            return queryset.annotate(assigned=Exists(links)).filter(assigned=True)
+        recipe_count = links.order_by().values(column).annotate(
+            count=Count('*')
+        ).values('count')
+        return queryset.annotate(
+            linked_recipes=Subquery(recipe_count, output_field=IntegerField())
+        ).filter(linked_recipes__gte=min_recipes)
 
     def perform_create(self, serializer):
-        """Creates objects for the current authenticated user."""
-        serializer.save(user=self.request.user)
+        """Creates objects for the current authenticated user.
+        A name the user already has, ignoring case, returns the existing object.
+        """
+        objects, _ = self.queryset.model.objects.bulk_get_or_create(
+            self.request.user, [serializer.validated_data['name']]
+        )
+        serializer.instance, = objects.values()
+
+    @action(methods=['POST'], detail=False)
+    def bulk(self, request):
+        """Get or create a list of names, returning a name to id map"""
+        max_length = self.queryset.model._meta.get_field('name').max_length
+        names = ListField(
+            child=CharField(max_length=max_length),
+            max_length=getattr(settings, 'RECIPE_BULK_MAX_ITEMS', 1000),
+        ).run_validation(request.data)
+        objects, created = self.queryset.model.objects.bulk_get_or_create(
+            request.user, names
+        )
+        return Response(
+            {name: objects[name_key(name)].id for name in names},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        )
+
+    @action(methods=['GET'], detail=False)
+    def autocomplete(self, request):
+        """Names starting with ?q=, most used first"""
+        limit = _limit_param(request, maximum=50)
+        rows = autocomplete.complete(
+            self.queryset.model, request.user.id, request.query_params.get('q', ''), limit
+        )
+        return Response([
+            {'id': pk, 'name': name, 'recipe_count': count} for pk, name, count in rows
+        ])
 
 
 class TagViewSet(BaseRecipeAttrViewSet):
     """Manage tags in the database"""
     queryset = Tag.objects.all()
     serializer_class = serializers.TagSerializer
+    recipe_field = 'tags'
 
 
 class IngredientViewSet(BaseRecipeAttrViewSet):
     """Manage ingredients in the database"""
     queryset = Ingredient.objects.all()
     serializer_class = serializers.IngredientSerializer
+    recipe_field = 'ingredients'
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     """Manage recipes in database, with extra functions UPDATE + VIEW DETAILS,
     not in db database above.
     """
@@ -51,33 +181,125 @@ class RecipeViewSet(viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     authentication_classes = (TokenAuthentication,)
     permission_classes = (IsAuthenticated,)
+    pagination_class = RecipeCursorPagination
+    prefetch_actions = ('list', 'retrieve', 'update', 'partial_update')
+    # related ids are listed in id order, matching RecipeValuesSerializer
+    related_querysets = {
+        'ingredients': Ingredient.objects.order_by('id'),
+        'tags': Tag.objects.order_by('id'),
+    }
+    range_params = ('time_minutes__lte', 'time_minutes__gte', 'price__lte', 'price__gte')
+    # each is served in index order by one of the (user, <field>, id) indexes
+    orderings = ('id', '-id', 'time_minutes', '-time_minutes', 'price', '-price')
 
     def _params_to_ints(self, qs):
         """Convert a list of string ID's to a list of integers"""
         return [int(str_id) for str_id in qs.split(',')]
 
+    def _filter_related(self, queryset, field, ids, match_all):
+        """Filter recipes linked to any (or with match_all, every) id"""
+        if not ids:
+            return queryset
+        if match_all:
+            for id_ in ids:
+                queryset = queryset.filter(**{f'{field}__id': id_})
+            return queryset
+        return queryset.filter(**{f'{field}__id__in': ids})
+
+    def _filter_ranges(self, queryset):
+        """Apply the time_minutes / price range parameters"""
+        filters, errors = {}, {}
+        for param in self.range_params:
+            value = self.request.query_params.get(param)
+            if value is None:
+                continue
+            field = Recipe._meta.get_field(param.split('__')[0])
+            try:
+                filters[param] = field.to_python(value)
+            except DjangoValidationError as exc:
+                errors[param] = exc.messages
+        if errors:
+            raise ValidationError(errors)
+        return queryset.filter(**filters)
+
+    def _cursor_ordering(self, ordering):
+        """Order by the field then id, both the same direction so the
+        (user, field, id) index is read forwards or backwards without a sort
+        """
+        field = ordering.lstrip('-')
+        if field == 'id':
+            return (ordering, )
+        return (ordering, ordering.replace(field, 'id'))
+
     def get_queryset(self):
         """Retrieve the recipes for the authorized user"""
         tags = self.request.query_params.get('tags')
         ingredients = self.request.query_params.get('ingredients')
+        # tags=1,2 matches either tag, add match=all to require both
+        match_all = self.request.query_params.get('match') == 'all'
         queryset = self.queryset                # won't affect class queryset
+        tag_ids = self._params_to_ints(tags) if tags else []
+        ingredient_ids = self._params_to_ints(ingredients) if ingredients else []
+
+        if (tag_ids or ingredient_ids) and bitmaps.enabled():
+            recipe_ids = bitmaps.get_index(self.request.user.id).resolve(
+                tag_ids, ingredient_ids, match_all
+            )
+            queryset = queryset.filter(id__in=recipe_ids)
+        else:
+            queryset = self._filter_related(queryset, 'tags', tag_ids, match_all)
+            queryset = self._filter_related(
+                queryset, 'ingredients', ingredient_ids, match_all
+            )
+
+        queryset = self._filter_ranges(queryset.filter(user=self.request.user))
+        search = self.request.query_params.get('search', '').strip()
+        if search:
+            queryset = recipe_search.search(queryset, self.request.user.id, search)
+            self.cursor_ordering = ('-search_rank', '-id')
+        # unknown orderings are ignored, like DRF's OrderingFilter does
+        ordering = self.request.query_params.get('ordering')
+        if ordering in self.orderings:
+            self.cursor_ordering = self._cursor_ordering(ordering)
 
-        if tags:
-            tag_ids = self._params_to_ints(tags)
-            queryset = queryset.filter(tags__id__in=tag_ids)
+        if self.action in self.prefetch_actions:
+            queryset = self._load_serialized_fields(queryset)
 
-        if ingredients:
-            ingredient_ids = self._params_to_ints(ingredients)
-            queryset = queryset.filter(ingredients__id__in=ingredient_ids)
+        return queryset
 
-        return queryset.filter(user=self.request.user)
+    def _load_serialized_fields(self, queryset):
+        """Load only the columns and relations the serializer will output"""
+        fields = serializers.requested_fields(
+            self.request, self.get_serializer_class().Meta.fields
+        )
+        relations = [name for name in ('ingredients', 'tags') if name in fields]
+        field_columns = serializers.RecipeSerializer.field_columns
+        columns = [field_columns.get(name, name) for name in fields if name not in relations]
+        # the paginator reads the ordering fields to build the cursors
+        ordering = [name.lstrip('-') for name in getattr(self, 'cursor_ordering', ())]
+        if self._fast_list():
+            # the values serializer loads the relations itself
+            return queryset.values(*{'id', *columns, *ordering})
+        # one query per relation instead of one per recipe
+        concrete = {field.name for field in Recipe._meta.concrete_fields}
+        columns += [name for name in ordering if name in concrete and name not in columns]
+        return queryset.only(*columns).prefetch_related(
+            *[Prefetch(name, queryset=self.related_querysets[name]) for name in relations]
+        )
+
+    def _fast_list(self):
+        return self.action == 'list' and getattr(settings, 'RECIPE_FAST_LIST', False)
 
     def get_serializer_class(self):
         """Return appropriate serializer class"""
-        if self.action == 'retrieve':
+        if self._fast_list():
+            return serializers.RecipeValuesSerializer
+        elif self.action == 'retrieve':
             return serializers.RecipeDetailSerializer
         elif self.action == 'upload_image':
             return serializers.RecipeImageSerializer
+        elif self.action == 'bulk':
+            return serializers.RecipeBulkSerializer
 
         return self.serializer_class
 
@@ -85,7 +307,115 @@ class RecipeViewSet(viewsets.ModelViewSet):
         """Create a new recipe"""
         serializer.save(user=self.request.user)
 
-    @action(methods=['POST'], detail=True, url_path='upload-image')
+    @action(methods=['POST'], detail=False)
+    def bulk(self, request):
+        """Create a list of recipes in one transaction"""
+        max_items = getattr(settings, 'RECIPE_BULK_MAX_ITEMS', 1000)
+        if not isinstance(request.data, list) or len(request.data) > max_items:
+            return Response(
+                {'detail': f'Expected a list of at most {max_items} recipes.'},
+                status.HTTP_400_BAD_REQUEST
+            )
+        serializer = self.get_serializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+        recipes = serializer.save(user=request.user)
+        rows = Recipe.objects.filter(
+            id__in=[recipe.id for recipe in recipes]
+        ).order_by('id').values(*serializers.RecipeValuesSerializer.COLUMNS)
+        return Response(
+            serializers.RecipeValuesSerializer(rows, context=self.get_serializer_context()).data,
+            status=status.HTTP_201_CREATED
+        )
+
+    @action(methods=['POST'], detail=False)
+    def pantry(self, request):
+        """List the recipes cookable from a set of ingredients, or lacking at
+        most max_missing of theirs, fewest missing first. The query params
+        of the list (tags, ranges, search) narrow the results further.
+        """
+        params = serializers.PantrySerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        pantry = set(params.validated_data['ingredients'])
+        # the cached index whether or not it answers the list filters
+        index = bitmaps.get_index(request.user.id)
+        missing = index.missing(pantry, params.validated_data['max_missing'])
+
+        recipe_ids = self.get_queryset().filter(id__in=list(missing)).values_list(
+            'id', flat=True
+        )
+        ranked = sorted(recipe_ids, key=lambda pk: (missing[pk], -pk))
+        ranked = ranked[:params.validated_data['limit']]
+        rows = Recipe.objects.filter(id__in=ranked).values(
+            *serializers.RecipeValuesSerializer.COLUMNS
+        )
+        position = {pk: i for i, pk in enumerate(ranked)}
+        data = serializers.RecipeValuesSerializer(
+            sorted(rows, key=lambda row: position[row['id']]),
+            context=self.get_serializer_context()
+        ).data
+        for item in data:
+            item['missing'] = [pk for pk in item['ingredients'] if pk not in pantry]
+        return Response(data)
+
+    @action(methods=['POST'], detail=False, url_path='shopping-list')
+    def shopping_list(self, request):
+        """Return the ingredients of the given recipes, once each with the
+        number of those recipes using it, in one grouped query
+        """
+        params = serializers.ShoppingListSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        rows = Recipe.ingredients.through.objects.filter(
+            recipe_id__in=params.validated_data['recipes'],
+            recipe__user=request.user,
+        ).values_list('ingredient_id', 'ingredient__name').annotate(
+            count=Count('*')
+        ).order_by('ingredient__name', 'ingredient_id')
+        return Response([
+            {'id': pk, 'name': name, 'count': count} for pk, name, count in rows
+        ])
+
+    @action(methods=['GET'], detail=True)
+    def similar(self, request, pk=None):
+        """List the recipes sharing the most tags and ingredients with this
+        one, by Jaccard similarity, from the user's MinHash/LSH index
+        """
+        recipe = self.get_object()
+        limit = _limit_param(request, maximum=100)
+        scores = dict(similar.get_index(request.user.id).similar(recipe.id, limit))
+
+        rows = Recipe.objects.filter(user=request.user, id__in=list(scores)).values(
+            *serializers.RecipeValuesSerializer.COLUMNS
+        )
+        rows = sorted(rows, key=lambda row: (-scores[row['id']], -row['id']))
+        data = serializers.RecipeValuesSerializer(
+            rows, context=self.get_serializer_context()
+        ).data
+        for row, item in zip(rows, data):
+            item['similarity'] = round(scores[row['id']], 4)
+        return Response(data)
+
+    @action(methods=['GET'], detail=False)
+    def export(self, request):
+        """Stream the user's recipes as newline delimited JSON"""
+        chunk_size = getattr(settings, 'RECIPE_EXPORT_CHUNK_SIZE', 2000)
+        fields = serializers.RecipeValuesSerializer.COLUMNS
+        # server-side cursor on PostgreSQL, only one chunk is held at a time
+        rows = self.get_queryset().order_by('id').values(*fields).iterator(
+            chunk_size=chunk_size
+        )
+        context = self.get_serializer_context()
+
+        def lines():
+            for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+                for item in serializers.RecipeValuesSerializer(chunk, context=context).data:
+                    yield json.dumps(item) + '\n'
+
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+    @action(methods=['POST'], detail=True, url_path='upload-image',
+            parser_classes=[ImageUploadParser])
     def upload_image(self, request, pk=None):
         """Upload image to recipe"""
         recipe = self.get_object()
@@ -95,6 +425,8 @@ class RecipeViewSet(viewsets.ModelViewSet):
         )
         if serializer.is_valid():
             serializer.save()
+            # the request returns now, the resizing happens in the pool
+            images.schedule_variants(recipe.image.name)
             return Response(
                 serializer.data,
                 status=status.HTTP_200_OK
@@ -104,4 +436,115 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return Response(
             serializer.errors,
             status.HTTP_400_BAD_REQUEST
-        )
\ No newline at end of file
+        )
+
+    @action(methods=['POST'], detail=True, url_path='uploads')
+    def create_upload(self, request, pk=None):
+        """Start a resumable upload of the recipe image"""
+        recipe = self.get_object()
+        params = serializers.UploadSessionSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        session = resumable.UploadSession.create(
+            request.user.id, recipe.id, **params.validated_data
+        )
+        return Response(session.as_dict(), status=status.HTTP_201_CREATED)
+
+    @action(methods=['GET', 'PUT'], detail=True, url_name='upload',
+            url_path=r'uploads/(?P<upload_id>[0-9a-f]{32})')
+    def upload(self, request, pk=None, upload_id=None):
+        """Report the received ranges, or PUT the range in Content-Range"""
+        recipe = self.get_object()
+        session = resumable.UploadSession.load(upload_id, request.user.id, recipe.id)
+        if request.method == 'PUT':
+            start, end = resumable.parse_content_range(
+                request.META.get('HTTP_CONTENT_RANGE'), session.size
+            )
+            received = session.write(start, end, request.stream or io.BytesIO())
+            if received < end - start:
+                return Response(
+                    dict(session.as_dict(), detail='The range was cut short.'),
+                    status.HTTP_400_BAD_REQUEST
+                )
+        return Response(session.as_dict())
+
+    @action(methods=['POST'], detail=True, url_name='upload-finalize',
+            url_path=r'uploads/(?P<upload_id>[0-9a-f]{32})/finalize')
+    def finalize_upload(self, request, pk=None, upload_id=None):
+        """Store the completed upload as the recipe image"""
+        recipe = self.get_object()
+        session = resumable.UploadSession.load(upload_id, request.user.id, recipe.id)
+        session.finalize(recipe)
+        images.schedule_variants(recipe.image.name)
+        return Response(
+            serializers.RecipeImageSerializer(recipe, context=self.get_serializer_context()).data
+        )
+
+
+class CacheStatsView(APIView):
+    """Report the response cache hit and miss counts"""
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(response_cache.stats())
+
+
+class RecipeImageResizeView(APIView):
+    """Serve a recipe image resized to ?w= as ?fmt=, rendered on the first
+    request. Responses for the current ?v= of the image at one of the
+    rendered widths never change and are cached for good; other requests
+    are redirected there, rounding the width up.
+    """
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, pk):
+        recipe = get_object_or_404(Recipe.objects.only('image'), pk=pk, user=request.user)
+        if not recipe.image:
+            raise NotFound('The recipe has no image.')
+        params = serializers.ResizeSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        width, fmt = params.validated_data['w'], params.validated_data['fmt']
+        version = resize.image_version(recipe.image.name)
+        if params.validated_data.get('v') != version or width != resize.allowed_width(width):
+            query = request.GET.copy()
+            query['v'] = version
+            query['w'] = resize.allowed_width(width)
+            response = HttpResponseRedirect(f'{request.path}?{query.urlencode()}')
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+
+        etag = quote_etag(f'{version}-{width}-{fmt}')
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            path = resize.resized(recipe.image.name, width, fmt)
+            response = media.serve_file(request, path, resize.FORMATS[fmt][1])
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, max_age=MEDIA_MAX_AGE, immutable=True)
+        return response
+
+
+class RecipeMediaView(APIView):
+    """Serve a recipe image or one of its variants to the recipe's owner.
+    Stored names are never reused, so the files are cached for good.
+    """
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, name):
+        recipes = Recipe.objects.filter(user=request.user)
+        prefix = images.original_prefix(name)
+        if prefix is not None:
+            recipes = recipes.filter(image__startswith=prefix)
+        else:
+            recipes = recipes.filter(image=name)
+        if not recipes.exists():
+            raise NotFound()
+        try:
+            path = default_storage.path(name)
+        except SuspiciousFileOperation:
+            raise NotFound()
+        response = media.serve_file(request, path)
+        patch_cache_control(response, private=True, max_age=MEDIA_MAX_AGE, immutable=True)
+        return response
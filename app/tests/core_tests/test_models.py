@@ -1,8 +1,15 @@
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 from unittest.mock import patch
+from importlib import import_module
+from django.apps import apps
+from django.db import connection
 from core import models
 
+merge_duplicate_names = import_module(
+    'core.migrations.0010_unique_tag_ingredient_names'
+).merge_duplicate_names
+
 
 def sample_user(email='sample@gmail.com', password='sample123'):
     """Creates sample user"""
@@ -79,4 +86,58 @@ class ModelTest(TestCase):
         file_path = models.recipe_image_file_path(None, 'test-image.jpg')
         exp_path = f"uploads/recipe/{uuid}.jpg"
 
-        self.assertEqual(file_path, exp_path)
\ No newline at end of file
+        self.assertEqual(file_path, exp_path)
+
+    def test_merge_duplicate_names(self):
+        """Test the name dedupe migration merges tags and keeps recipe links"""
+        user = sample_user()
+        recipe = models.Recipe.objects.create(
+            user=user, title='Soup', time_minutes=10, price=4.50
+        )
+        with connection.cursor() as cursor:
+            # rolled back with the test transaction
+            cursor.execute('DROP INDEX core_tag_user_lower_name_uniq')
+        salt = models.Tag.objects.create(user=user, name='Salt')
+        dupe = models.Tag.objects.create(user=user, name=' salt  ')
+        other = models.Tag.objects.create(user=user, name='Pepper')
+        recipe.tags.add(dupe, other)
+
+        merge_duplicate_names(apps, None)
+
+        self.assertEqual(
+            list(models.Tag.objects.filter(user=user).order_by('id')),
+            [salt, other]
+        )
+        self.assertEqual(set(recipe.tags.all()), {salt, other})
+
+    def test_recipe_count_tracks_links(self):
+        """Test recipe_count follows adds, removes, clears and deletes"""
+        user = sample_user()
+        salt = models.Tag.objects.create(user=user, name='Salt')
+        pepper = models.Tag.objects.create(user=user, name='Pepper')
+        soup, stew = (
+            models.Recipe.objects.create(
+                user=user, title=title, time_minutes=10, price=4.50
+            ) for title in ('Soup', 'Stew')
+        )
+
+        def counts():
+            return dict(models.Tag.objects.values_list('name', 'recipe_count'))
+
+        soup.tags.add(salt, pepper)
+        soup.tags.add(salt)
+        pepper.recipe_set.add(stew)
+        self.assertEqual(counts(), {'Salt': 1, 'Pepper': 2})
+
+        stew.tags.remove(salt, pepper)
+        self.assertEqual(counts(), {'Salt': 1, 'Pepper': 1})
+
+        soup.tags.clear()
+        self.assertEqual(counts(), {'Salt': 0, 'Pepper': 0})
+
+        salt.recipe_set.add(soup, stew)
+        salt.recipe_set.remove(stew)
+        self.assertEqual(counts(), {'Salt': 1, 'Pepper': 0})
+
+        soup.delete()
+        self.assertEqual(counts(), {'Salt': 0, 'Pepper': 0})
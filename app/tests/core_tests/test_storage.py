@@ -0,0 +1,140 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, transaction
+from django.test import TransactionTestCase, override_settings
+from unittest.mock import patch
+from PIL import Image
+
+from core.models import Recipe, StoredFile
+
+
+def sample_png(color):
+    out = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(out, format='PNG')
+    return out.getvalue()
+
+
+# images are only deleted once the transaction commits
+@override_settings(RECIPE_CONTENT_ADDRESSED_IMAGES=True)
+class RecipeImageStorageTests(TransactionTestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = get_user_model().objects.create_user('tester@gmail.com', 'pass123')
+        self.data = sample_png('red')
+
+    def recipe(self, **params):
+        return Recipe.objects.create(
+            user=self.user, title='Toast', time_minutes=5, price=1, **params
+        )
+
+    def recipe_with_image(self, data=None):
+        recipe = self.recipe()
+        recipe.image.save('photo.PNG', ContentFile(data or self.data))
+        return recipe
+
+    def test_identical_images_stored_once(self):
+        """Test the same bytes are stored once under their sharded hash"""
+        one = self.recipe_with_image()
+        two = self.recipe_with_image()
+
+        digest = hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(
+            one.image.name, f'uploads/recipe/{digest[:2]}/{digest[2:4]}/{digest}.png'
+        )
+        self.assertEqual(two.image.name, one.image.name)
+        self.assertEqual(os.listdir(os.path.dirname(one.image.path)), [f'{digest}.png'])
+        self.assertEqual(StoredFile.objects.get(name=one.image.name).ref_count, 2)
+
+    def test_shared_image_kept_until_unreferenced(self):
+        """Test a shared image is only deleted with its last reference"""
+        one = self.recipe_with_image()
+        two = self.recipe_with_image()
+        clone = self.recipe(image=one.image.name)
+        path = one.image.path
+
+        one.delete()
+        two.image.delete()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(StoredFile.objects.get(name=clone.image.name).ref_count, 1)
+
+        clone.delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(StoredFile.objects.exists())
+
+    def test_replaced_image_released(self):
+        """Test replacing an image deletes the unreferenced previous one"""
+        recipe = self.recipe_with_image()
+        previous = recipe.image.path
+
+        recipe.image.save('other.png', ContentFile(sample_png('blue')))
+
+        self.assertFalse(os.path.exists(previous))
+        self.assertTrue(os.path.exists(recipe.image.path))
+        self.assertEqual(
+            list(StoredFile.objects.values_list('name', 'ref_count')),
+            [(recipe.image.name, 1)]
+        )
+
+    def test_reused_image_counted_before_collected(self):
+        """Test reusing a file counts it before its last previous reference
+        is collected, so the file isn't deleted from under the new recipe
+        """
+        one = self.recipe_with_image()
+        path = one.image.path
+        recipe = self.recipe()
+
+        with transaction.atomic():
+            one.delete()
+            # the same bytes uploaded before the delete commits and collects
+            recipe.image.save('photo.png', ContentFile(self.data), save=False)
+        recipe.save()
+
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(StoredFile.objects.get(name=recipe.image.name).ref_count, 1)
+
+    def test_same_image_saved_again_counted_once(self):
+        """Test saving a recipe's image again keeps a single reference"""
+        recipe = self.recipe_with_image()
+
+        recipe.image.save('photo.png', ContentFile(self.data))
+
+        self.assertTrue(os.path.exists(recipe.image.path))
+        self.assertEqual(StoredFile.objects.get(name=recipe.image.name).ref_count, 1)
+
+    def test_failed_save_releases_image(self):
+        """Test the reference counted by saving a file is released when
+        saving the recipe fails, and the file collected
+        """
+        recipe = self.recipe()
+
+        with patch.object(Recipe, 'save_base', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                recipe.image.save('photo.png', ContentFile(self.data))
+
+        self.assertFalse(os.path.exists(recipe.image.path))
+        self.assertFalse(StoredFile.objects.exists())
+        self.assertNotIn('_taken_images', recipe.__dict__)
+
+        recipe = self.recipe_with_image()
+        self.assertEqual(StoredFile.objects.get(name=recipe.image.name).ref_count, 1)
+
+    @override_settings(RECIPE_CONTENT_ADDRESSED_IMAGES=False)
+    def test_random_names_when_not_content_addressed(self):
+        """Test images keep their random names with the mode off"""
+        one = self.recipe_with_image()
+        two = self.recipe_with_image()
+
+        self.assertRegex(one.image.name, r'^uploads/recipe/[0-9a-f-]{36}\.PNG$')
+        self.assertNotEqual(one.image.name, two.image.name)
+        self.assertEqual(StoredFile.objects.get(name=one.image.name).ref_count, 1)
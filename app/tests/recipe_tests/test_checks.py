@@ -0,0 +1,35 @@
+from django.test import SimpleTestCase, override_settings
+
+from recipe import checks
+
+LOCMEM = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class CheckTests(SimpleTestCase):
+
+    def test_version_cache_shared(self):
+        """Test the configured version cache passes"""
+        self.assertEqual(checks.check_version_cache(None), [])
+
+    @override_settings(CACHES=LOCMEM)
+    def test_version_cache_process_local(self):
+        """Test a per-process version cache is refused"""
+        errors = checks.check_version_cache(None)
+
+        self.assertEqual([error.id for error in errors], ['recipe.E001'])
+
+    @override_settings(RECIPE_CACHE_ALIAS='versions')
+    def test_version_cache_missing(self):
+        """Test an unknown version cache alias is refused"""
+        errors = checks.check_version_cache(None)
+
+        self.assertEqual([error.id for error in errors], ['recipe.E001'])
+
+    @override_settings(CACHES=LOCMEM)
+    def test_response_cache_process_local(self):
+        """Test a per-process response cache is refused while enabled"""
+        errors = checks.check_response_cache(None)
+        self.assertEqual([error.id for error in errors], ['recipe.E002'])
+
+        with self.settings(RECIPE_RESPONSE_CACHE=False):
+            self.assertEqual(checks.check_response_cache(None), [])
@@ -0,0 +1,48 @@
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+
+from core.models import Tag, Ingredient, Recipe
+
+
+class ReconcileRecipeCountsTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('sample@gmail.com', 'password123')
+        self.recipe = Recipe.objects.create(
+            user=self.user, title='Soup', time_minutes=10, price=4.50
+        )
+        self.tags = [Tag.objects.create(user=self.user, name=f'tag {i}') for i in range(5)]
+        self.ingredient = Ingredient.objects.create(user=self.user, name='Salt')
+        self.recipe.tags.add(*self.tags[:3])
+        self.recipe.ingredients.add(self.ingredient)
+
+    def test_reconcile_fixes_drift(self):
+        """Test drifted counts are recomputed across batches"""
+        Tag.objects.filter(pk=self.tags[0].pk).update(recipe_count=7)
+        Tag.objects.filter(pk=self.tags[4].pk).update(recipe_count=1)
+        Recipe.tags.through.objects.filter(tag=self.tags[2]).delete()
+
+        out = StringIO()
+        call_command('reconcile_recipe_counts', batch_size=2, stdout=out)
+
+        self.assertIn('tags: 3 drifted', out.getvalue())
+        self.assertEqual(
+            list(Tag.objects.order_by('id').values_list('recipe_count', flat=True)),
+            [1, 1, 0, 0, 0]
+        )
+        self.ingredient.refresh_from_db()
+        self.assertEqual(self.ingredient.recipe_count, 1)
+
+    def test_reconcile_dry_run(self):
+        """Test a dry run reports drift without fixing it"""
+        Tag.objects.filter(pk=self.tags[0].pk).update(recipe_count=7)
+
+        out = StringIO()
+        call_command('reconcile_recipe_counts', dry_run=True, stdout=out)
+
+        self.assertIn('tags: 1 drifted', out.getvalue())
+        self.tags[0].refresh_from_db()
+        self.assertEqual(self.tags[0].recipe_count, 7)
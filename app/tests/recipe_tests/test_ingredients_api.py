@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.urls import reverse
 from django.test import TestCase
 from rest_framework import status
@@ -34,6 +35,7 @@ class PrivateIngredientAPITest(TestCase):
             password='pass123'
         )
         self.client.force_authenticate(user=self.user)
+        cache.clear()
 
     def test_retrieve_ingredients(self):
         """Test to retrieve ingredients"""
@@ -95,6 +97,7 @@ class PrivateIngredientAPITest(TestCase):
 
         resp = self.client.get(INGREDIENTS_URL, {'assigned_only': 1})
 
+        ingredient1.refresh_from_db()
         serializer1 = IngredientSerializer(ingredient1)
         serializer2 = IngredientSerializer(ingredient2)
 
@@ -1,17 +1,44 @@
+import json
 import tempfile
+import io
 import os
-from PIL import Image
+import shutil
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest import skipUnless
+from unittest.mock import Mock, patch
+from PIL import Image, features
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
-from rest_framework.test import APIClient
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
 
 from core.models import Recipe, Tag, Ingredient
+from recipe import bitmaps, images, resize, resumable, similar, versions
+from recipe import cache as response_cache
+from recipe import search as recipe_search
 from recipe.serializers import RecipeSerializer, RecipeDetailSerializer
+from recipe.uploads import ImageUploadHandler
 
 
 RECIPES_URL = reverse('recipe:recipe-list')
+CACHE_STATS_URL = reverse('recipe:cache-stats')
+EXPORT_URL = reverse('recipe:recipe-export')
+BULK_URL = reverse('recipe:recipe-bulk')
+PANTRY_URL = reverse('recipe:recipe-pantry')
+SHOPPING_LIST_URL = reverse('recipe:recipe-shopping-list')
 
 
 def sample_recipe(user, **params):
@@ -36,16 +63,50 @@ def sample_ingredient(user, name='Sample Ingredient'):
     return Ingredient.objects.create(user=user, name=name)
 
 
+def sideways_jpeg(size):
+    """Return JPEG bytes of size tagged to be shown rotated by 90 degrees,
+    as phone cameras store portrait photos
+    """
+    exif = Image.Exif()
+    exif[0x0112] = 6    # orientation
+    out = io.BytesIO()
+    Image.new('RGB', size).save(out, format='JPEG', exif=exif.tobytes())
+    return out.getvalue()
+
+
 def detail_url(recipe_id):
     """return recipe detail URL"""
     return reverse('recipe:recipe-detail', args=[recipe_id])
 
 
+def similar_url(recipe_id):
+    """Return the similar recipes URL"""
+    return reverse('recipe:recipe-similar', args=[recipe_id])
+
+
+def uploads_url(recipe_id, upload_id=None, finalize=False):
+    """Return a resumable upload URL"""
+    if upload_id is None:
+        return reverse('recipe:recipe-create-upload', args=[recipe_id])
+    name = 'recipe:recipe-upload-finalize' if finalize else 'recipe:recipe-upload'
+    return reverse(name, kwargs={'pk': recipe_id, 'upload_id': upload_id})
+
+
 def upload_image_url(recipe_id):
     """Return an upload image URL"""
     return reverse('recipe:recipe-upload-image', args=[recipe_id])
 
 
+def resize_url(recipe_id):
+    """Return the resized image URL"""
+    return reverse('recipe-image-resize', args=[recipe_id])
+
+
+def media_url(name):
+    """Return the URL of a stored media file"""
+    return reverse('recipe-media', args=[name])
+
+
 class PublicRecipeAPITests(TestCase):
     """Test publicly available Recipe API"""
 
@@ -69,6 +130,7 @@ class PrivateRecipeAPITests(TestCase):
             'pass123'
         )
         self.client.force_authenticate(user=self.user)
+        cache.clear()
 
     def test_retrieve_recipes(self):
         """Test retrieving a list of recipes"""
@@ -80,7 +142,7 @@ class PrivateRecipeAPITests(TestCase):
         serializer = RecipeSerializer(recipes, many=True)
 
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
-        self.assertEqual(resp.data, serializer.data)
+        self.assertEqual(resp.data['results'], serializer.data)
 
     def test_recipes_limited_to_user(self):
         """Test recipes are limited to authorised user only"""
@@ -99,8 +161,20 @@ class PrivateRecipeAPITests(TestCase):
         serializer = RecipeSerializer(recipe, many=True)
 
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
-        self.assertEqual(resp.data, serializer.data)
-        self.assertEqual(len(resp.data), 1)
+        self.assertEqual(resp.data['results'], serializer.data)
+        self.assertEqual(len(resp.data['results']), 1)
+
+    def test_recipes_paginated_by_cursor(self):
+        """Test the recipe list is split into keyset pages"""
+        recipes = [sample_recipe(user=self.user) for _ in range(5)]
+
+        resp = self.client.get(RECIPES_URL, {'page_size': 2})
+        ids = [r['id'] for r in resp.data['results']]
+        while resp.data['next']:
+            resp = self.client.get(resp.data['next'])
+            ids += [r['id'] for r in resp.data['results']]
+
+        self.assertEqual(ids, sorted((r.id for r in recipes), reverse=True))
 
     def test_view_recipe_detail(self):
         """Test viewing a recipe detail"""
@@ -115,6 +189,199 @@ class PrivateRecipeAPITests(TestCase):
 
         self.assertEqual(resp.data, serializer.data)
 
+    def test_list_recipes_query_count(self):
+        """Test listing recipes runs a fixed number of queries"""
+        tag = sample_tag(user=self.user)
+        ingredient = sample_ingredient(user=self.user)
+        for _ in range(10):
+            recipe = sample_recipe(user=self.user)
+            recipe.tags.add(tag)
+            recipe.ingredients.add(ingredient)
+
+        # recipes page + ingredients prefetch + tags prefetch
+        with self.assertNumQueries(3):
+            resp = self.client.get(RECIPES_URL)
+
+        self.assertEqual(len(resp.data['results']), 10)
+
+    def test_list_recipes_sparse_fields(self):
+        """Test ?fields= trims the payload and skips unused relations"""
+        recipe = sample_recipe(user=self.user)
+        recipe.tags.add(sample_tag(user=self.user))
+
+        with self.assertNumQueries(1):
+            resp = self.client.get(RECIPES_URL, {'fields': 'id,title'})
+
+        self.assertEqual(
+            resp.data['results'],
+            [{'id': recipe.id, 'title': recipe.title}]
+        )
+
+    def test_list_recipes_omit_fields(self):
+        """Test ?omit= drops fields from the payload"""
+        sample_recipe(user=self.user)
+
+        with self.assertNumQueries(2):
+            resp = self.client.get(RECIPES_URL, {'omit': 'tags,link'})
+
+        self.assertEqual(
+            set(resp.data['results'][0]),
+            {'id', 'title', 'ingredients', 'time_minutes', 'price', 'image_variants'}
+        )
+
+    def test_list_recipes_not_modified(self):
+        """Test an unchanged list is answered with 304 without queries"""
+        sample_recipe(user=self.user)
+        resp = self.client.get(RECIPES_URL)
+        etag = resp['ETag']
+
+        with self.assertNumQueries(0):
+            resp = self.client.get(RECIPES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp['ETag'], etag)
+
+    def test_list_recipes_etag_changes_on_write(self):
+        """Test recipe, tag and M2M writes change the list ETag"""
+        recipe = sample_recipe(user=self.user)
+        etags = [self.client.get(RECIPES_URL)['ETag']]
+
+        tag = sample_tag(user=self.user)
+        etags.append(self.client.get(RECIPES_URL)['ETag'])
+        recipe.tags.add(tag)
+        etags.append(self.client.get(RECIPES_URL)['ETag'])
+        recipe.title = 'Renamed'
+        recipe.save()
+        resp = self.client.get(RECIPES_URL, HTTP_IF_NONE_MATCH=etags[-1])
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(set(etags + [resp['ETag']])), 4)
+
+    def test_list_recipes_served_from_cache(self):
+        """Test a repeated list is served from the response cache"""
+        sample_recipe(user=self.user)
+        resp1 = self.client.get(RECIPES_URL)
+
+        with self.assertNumQueries(0):
+            resp2 = self.client.get(RECIPES_URL)
+
+        self.assertEqual(resp1['X-Cache'], 'MISS')
+        self.assertEqual(resp2['X-Cache'], 'HIT')
+        self.assertEqual(resp1.data, resp2.data)
+
+    def test_list_recipes_cache_invalidated_on_write(self):
+        """Test writes to the user's recipes invalidate cached lists"""
+        recipe = sample_recipe(user=self.user)
+        self.client.get(RECIPES_URL)
+        recipe.tags.add(sample_tag(user=self.user))
+
+        resp = self.client.get(RECIPES_URL)
+
+        self.assertEqual(resp['X-Cache'], 'MISS')
+        self.assertEqual(len(resp.data['results'][0]['tags']), 1)
+
+    def test_list_recipes_cache_keyed_by_params(self):
+        """Test different query params are cached separately"""
+        sample_recipe(user=self.user)
+        self.client.get(RECIPES_URL, {'fields': 'id'})
+
+        resp = self.client.get(RECIPES_URL, {'fields': 'id,title'})
+
+        self.assertEqual(resp['X-Cache'], 'MISS')
+        self.assertIn('title', resp.data['results'][0])
+
+    @override_settings(RECIPE_RESPONSE_CACHE_LOCK_TIMEOUT=0.1)
+    def test_list_recipes_cache_lock_expires(self):
+        """Test a request waiting on a stale rebuild lock computes the list"""
+        sample_recipe(user=self.user)
+        request = APIRequestFactory().get(RECIPES_URL)
+        force_authenticate(request, user=self.user)
+        key = response_cache.make_key(
+            Request(request), versions.get_version(self.user.id)
+        )
+        cache.add(f'{key}:lock', 1)
+
+        resp = self.client.get(RECIPES_URL)
+
+        self.assertEqual(resp['X-Cache'], 'MISS')
+        self.assertEqual(len(resp.data['results']), 1)
+
+    def test_cache_stats_admin_only(self):
+        """Test cache metrics are only exposed to admins"""
+        resp = self.client.get(CACHE_STATS_URL)
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        before = self.client.get(CACHE_STATS_URL).data
+        self.client.get(RECIPES_URL)
+        self.client.get(RECIPES_URL)
+        after = self.client.get(CACHE_STATS_URL).data
+
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+
+    def test_list_recipes_fast_path_matches_serializer(self):
+        """Test the values() fast path renders the same bytes"""
+        tag1 = sample_tag(user=self.user, name='One')
+        tag2 = sample_tag(user=self.user, name='Two')
+        ingredient = sample_ingredient(user=self.user)
+        recipe = sample_recipe(user=self.user, price=5.5, link='http://x.io')
+        recipe.tags.add(tag2)
+        recipe.tags.add(tag1)
+        recipe.ingredients.add(ingredient)
+        sample_recipe(user=self.user)
+
+        with self.settings(RECIPE_RESPONSE_CACHE=False):
+            regular = self.client.get(RECIPES_URL)
+            with self.settings(RECIPE_FAST_LIST=True), self.assertNumQueries(3):
+                fast = self.client.get(RECIPES_URL)
+
+        self.assertEqual(fast.content, regular.content)
+        self.assertEqual(
+            fast.data['results'],
+            RecipeSerializer(Recipe.objects.order_by('-id'), many=True).data
+        )
+
+    @override_settings(RECIPE_FAST_LIST=True)
+    def test_list_recipes_fast_path_sparse_fields(self):
+        """Test the fast path honours ?fields= and skips unused relations"""
+        recipe = sample_recipe(user=self.user)
+
+        with self.assertNumQueries(1):
+            resp = self.client.get(RECIPES_URL, {'fields': 'title,price'})
+
+        self.assertEqual(
+            resp.data['results'],
+            [{'title': recipe.title, 'price': '8.00'}]
+        )
+
+    @override_settings(RECIPE_EXPORT_CHUNK_SIZE=2)
+    def test_export_recipes_ndjson(self):
+        """Test exporting streams one JSON recipe per line"""
+        tag = sample_tag(user=self.user)
+        recipes = [sample_recipe(user=self.user) for _ in range(5)]
+        recipes[3].tags.add(tag)
+        sample_recipe(user=get_user_model().objects.create_user('o@x.io', 'pass123'))
+
+        resp = self.client.get(EXPORT_URL)
+        lines = b''.join(resp.streaming_content).decode().splitlines()
+
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            json.loads(json.dumps(RecipeSerializer(recipes, many=True).data))
+        )
+
+    def test_view_recipe_detail_query_count(self):
+        """Test a recipe detail runs a fixed number of queries"""
+        recipe = sample_recipe(user=self.user)
+        recipe.tags.add(sample_tag(user=self.user), sample_tag(user=self.user, name='Two'))
+        recipe.ingredients.add(sample_ingredient(user=self.user))
+
+        with self.assertNumQueries(3):
+            self.client.get(detail_url(recipe.id))
+
 
     ### Errors with the below
     def test_create_basic_recipe(self):
@@ -175,6 +442,49 @@ class PrivateRecipeAPITests(TestCase):
         self.assertIn(ingredient1, ingredients)
         self.assertIn(ingredient2, ingredients)
 
+    def test_bulk_create_recipes(self):
+        """Test creating many recipes with their tags and ingredients"""
+        tag = sample_tag(user=self.user)
+        ingredient1 = sample_ingredient(user=self.user, name='Salt')
+        ingredient2 = sample_ingredient(user=self.user, name='Pepper')
+        payload = [
+            {'title': 'Soup', 'time_minutes': 30, 'price': '4.00',
+             'tags': [tag.id], 'ingredients': [ingredient1.id, ingredient2.id]},
+            {'title': 'Toast', 'time_minutes': 5, 'price': '1.50'},
+        ]
+        etag = self.client.get(RECIPES_URL)['ETag']
+
+        # recipes are inserted one by one where bulk inserts return no ids,
+        # then one recipe_count update per tag/ingredient used
+        with self.assertNumQueries(15 if connection.features.can_return_ids_from_bulk_insert
+                                   else 16):
+            resp = self.client.post(BULK_URL, payload, format='json')
+
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        recipes = Recipe.objects.filter(user=self.user).order_by('id')
+        self.assertEqual(resp.data, RecipeSerializer(recipes, many=True).data)
+        self.assertEqual(list(recipes[0].tags.all()), [tag])
+        self.assertEqual(recipes[0].ingredients.count(), 2)
+        self.assertNotEqual(self.client.get(RECIPES_URL)['ETag'], etag)
+
+    def test_bulk_create_reports_item_errors(self):
+        """Test a bulk create with bad items creates nothing"""
+        other_user = get_user_model().objects.create_user('o@x.io', 'pass123')
+        tag = sample_tag(user=other_user)
+        payload = [
+            {'title': 'Soup', 'time_minutes': 30, 'price': '4.00'},
+            {'title': 'Toast', 'time_minutes': 5, 'price': '1.50', 'tags': [tag.id]},
+            {'title': '', 'time_minutes': 5, 'price': '1.50'},
+        ]
+
+        resp = self.client.post(BULK_URL, payload, format='json')
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.data[0], {})
+        self.assertIn('tags', resp.data[1])
+        self.assertIn('title', resp.data[2])
+        self.assertFalse(Recipe.objects.filter(user=self.user).exists())
+
     def test_partial_update_recipe(self):
         recipe = sample_recipe(user=self.user)               # title = 'Sample Recipe'
         recipe.tags.add(sample_tag(user=self.user))          # tag = 'Sample Tag'
@@ -221,10 +531,15 @@ class RecipeImageUploadTests(TestCase):
             'pass123'
         )
         self.client.force_authenticate(user=self.user)
+        cache.clear()
         self.recipe = sample_recipe(user=self.user)
 
     def tearDown(self):
-        self.recipe.image.delete()
+        if self.recipe.image:
+            images.delete_variants(self.recipe.image.name)
+            # the test transaction never commits, so the image is never collected
+            if os.path.exists(self.recipe.image.path):
+                os.remove(self.recipe.image.path)
 
     def test_upload_image_to_recipe(self):
         """Test uploading an image to the recipe"""
@@ -241,6 +556,104 @@ class RecipeImageUploadTests(TestCase):
         self.assertIn('image', resp.data)
         self.assertTrue(os.path.exists(self.recipe.image.path))
 
+    def test_upload_image_schedules_variants(self):
+        """Test an upload returns the variant URLs and defers the resizing"""
+        url = upload_image_url(self.recipe.id)
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as ntf:
+            Image.new('RGB', (800, 200)).save(ntf, format='JPEG')
+            ntf.seek(0)
+            with patch('recipe.images.schedule_variants') as schedule:
+                resp = self.client.post(url, {'image': ntf}, format='multipart')
+
+        self.recipe.refresh_from_db()
+        self.assertEqual(list(resp.data['image_variants']), ['thumb', 'card', 'full'])
+        self.assertTrue(resp.data['image_variants']['thumb'].endswith('_thumb.jpg'))
+        schedule.assert_called_once_with(self.recipe.image.name)
+        self.assertFalse(default_storage.exists(
+            images.variant_name(self.recipe.image.name, 'thumb')
+        ))
+
+        # what runs once the upload commits
+        images.generate_variants(self.recipe.image.name).result(timeout=60)
+
+        sizes = {}
+        for variant in images.VARIANTS:
+            with default_storage.open(images.variant_name(self.recipe.image.name, variant)) as f:
+                sizes[variant] = Image.open(f).size
+        self.assertEqual(sizes, {'thumb': (150, 150), 'card': (600, 400), 'full': (800, 200)})
+
+        resp = self.client.get(detail_url(self.recipe.id))
+        self.assertEqual(
+            resp.data['image_variants'],
+            images.variant_urls(self.recipe.image.name, resp.wsgi_request)
+        )
+
+    def upload_bytes(self, data, name='photo.jpg'):
+        upload = SimpleUploadedFile(name, data)
+        return self.client.post(
+            upload_image_url(self.recipe.id), {'image': upload}, format='multipart'
+        )
+
+    def test_variants_follow_exif_orientation(self):
+        """Test variants of a sideways stored photo come out upright"""
+        rendered = images.render_variants(sideways_jpeg((800, 200)))
+
+        self.assertEqual(Image.open(io.BytesIO(rendered['full'])).size, (200, 800))
+
+    def test_image_pool_replaced_after_crash(self):
+        """Test a worker dying doesn't break later renders"""
+        crash = images.submit(os._exit, 1)
+        with self.assertRaises(BrokenProcessPool):
+            crash.result(timeout=60)
+
+        self.assertEqual(images.submit(pow, 2, 10).result(timeout=60), 1024)
+
+    @override_settings(RECIPE_IMAGE_MAX_BYTES=1024)
+    def test_upload_image_too_large(self):
+        """Test an oversize upload is refused with 413 and not stored"""
+        img = Image.frombytes('RGB', (300, 300), os.urandom(300 * 300 * 3))
+        out = io.BytesIO()
+        img.save(out, format='JPEG', quality=95)
+
+        resp = self.upload_bytes(out.getvalue())
+
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.recipe.refresh_from_db()
+        self.assertFalse(self.recipe.image)
+
+    def test_upload_image_unsupported_format(self):
+        """Test a file that isn't an image is refused from its magic bytes"""
+        resp = self.upload_bytes(b'%PDF-1.4\n' + b'0' * 1000)
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('image', resp.data)
+
+    @override_settings(RECIPE_IMAGE_MAX_PIXELS=50)
+    def test_upload_image_too_many_pixels(self):
+        """Test an image over the pixel limit is refused"""
+        out = io.BytesIO()
+        Image.new('RGB', (10, 10)).save(out, format='PNG')
+
+        resp = self.upload_bytes(out.getvalue(), name='photo.png')
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('50 pixels', str(resp.data['image']))
+
+    def test_upload_image_rejected_from_header(self):
+        """Test huge dimensions are refused on the first chunk"""
+        def chunk(kind, data):
+            return (struct.pack('>I', len(data)) + kind + data
+                    + struct.pack('>I', zlib.crc32(kind + data)))
+
+        ihdr = struct.pack('>IIBBBBB', 100000, 100000, 8, 2, 0, 0, 0)
+        first = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', b'\0' * 1024)
+        handler = ImageUploadHandler()
+        handler.new_file('image', 'huge.png', 'image/png', None)
+
+        with self.assertRaises(ValidationError):
+            handler.receive_data_chunk(first, 0)
+        self.assertTrue(handler.file.closed)
+
     def test_upload_image_bad_request(self):
         """Test uploading an invalid image"""
         url = upload_image_url(self.recipe.id)
@@ -249,6 +662,141 @@ class RecipeImageUploadTests(TestCase):
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class RecipeResumableUploadTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'tester@gmail.com',
+            'pass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        cache.clear()
+        self.recipe = sample_recipe(user=self.user)
+        self.session_dir = tempfile.mkdtemp()
+        settings = override_settings(RECIPE_UPLOAD_SESSION_DIR=self.session_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        out = io.BytesIO()
+        Image.frombytes('RGB', (64, 64), os.urandom(64 * 64 * 3)).save(out, format='PNG')
+        self.data = out.getvalue()
+
+    def tearDown(self):
+        shutil.rmtree(self.session_dir)
+        if self.recipe.image and os.path.exists(self.recipe.image.path):
+            os.remove(self.recipe.image.path)
+
+    def start(self):
+        resp = self.client.post(
+            uploads_url(self.recipe.id),
+            {'size': len(self.data), 'filename': 'photo.png'}, format='json'
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return resp.data['id']
+
+    def put(self, upload_id, start, end, body=None):
+        return self.client.put(
+            uploads_url(self.recipe.id, upload_id),
+            self.data[start:end] if body is None else body,
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes {start}-{end - 1}/{len(self.data)}',
+        )
+
+    def test_resumable_upload(self):
+        """Test ranges sent out of order and retried assemble the image"""
+        upload_id = self.start()
+        size, half = len(self.data), len(self.data) // 2
+
+        resp = self.put(upload_id, 0, half)
+        self.assertEqual(resp.data['offset'], half)
+        self.put(upload_id, half + 100, size)
+        self.put(upload_id, half - 50, half + 200)
+        resp = self.client.get(uploads_url(self.recipe.id, upload_id))
+        self.assertEqual(resp.data['ranges'], [[0, size]])
+
+        with patch('recipe.images.schedule_variants') as schedule:
+            resp = self.client.post(uploads_url(self.recipe.id, upload_id, finalize=True))
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.recipe.refresh_from_db()
+        self.assertRegex(self.recipe.image.name, r'^uploads/recipe/[0-9a-f-]{36}\.png$')
+        with self.recipe.image.open('rb') as f:
+            self.assertEqual(f.read(), self.data)
+        schedule.assert_called_once_with(self.recipe.image.name)
+        self.assertEqual(resumable.UploadSession.open_sessions(self.user.id), [])
+
+    def test_resumable_upload_resumes_cut_range(self):
+        """Test the bytes of an interrupted range are kept"""
+        upload_id = self.start()
+
+        resp = self.put(upload_id, 0, 1000, body=self.data[:600])
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.data['offset'], 600)
+        resp = self.client.post(uploads_url(self.recipe.id, upload_id, finalize=True))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_resumable_upload_rejects_bad_input(self):
+        """Test bad ranges, oversize sessions and other users' sessions"""
+        upload_id = self.start()
+        resp = self.client.put(
+            uploads_url(self.recipe.id, upload_id), b'abc',
+            content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 0-2/3',
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with override_settings(RECIPE_IMAGE_MAX_BYTES=100):
+            resp = self.client.post(
+                uploads_url(self.recipe.id), {'size': 101, 'filename': 'a.png'}, format='json'
+            )
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        user2 = get_user_model().objects.create_user('other@gmail.com', 'pass123')
+        self.client.force_authenticate(user=user2)
+        resp = self.client.get(uploads_url(self.recipe.id, upload_id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(RECIPE_UPLOAD_SESSIONS_PER_USER=2)
+    def test_resumable_upload_sessions_capped(self):
+        """Test a recipe holds one session and a user a limited number"""
+        first = self.start()
+        second = self.start()
+        resp = self.client.get(uploads_url(self.recipe.id, first))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.get(uploads_url(self.recipe.id, second))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        self.recipe = sample_recipe(user=self.user, title='Second')
+        self.start()
+        self.recipe = sample_recipe(user=self.user, title='Third')
+        resp = self.client.post(
+            uploads_url(self.recipe.id), {'size': len(self.data), 'filename': 'a.png'},
+            format='json'
+        )
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        with override_settings(RECIPE_UPLOAD_SESSIONS_PER_USER=10,
+                               RECIPE_UPLOAD_BYTES_PER_USER=3 * len(self.data) - 1):
+            resp = self.client.post(
+                uploads_url(self.recipe.id), {'size': len(self.data), 'filename': 'a.png'},
+                format='json'
+            )
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(len(resumable.UploadSession.open_sessions(self.user.id)), 2)
+
+    def test_resumable_upload_checks_image(self):
+        """Test an assembled file that isn't an image is refused"""
+        self.data = b'%PDF-1.4\n' + b'0' * 100
+        upload_id = self.start()
+        self.put(upload_id, 0, len(self.data))
+
+        resp = self.client.post(uploads_url(self.recipe.id, upload_id, finalize=True))
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.recipe.refresh_from_db()
+        self.assertFalse(self.recipe.image)
+
+
 class RecipeFilteringTests(TestCase):
 
     def setUp(self):
@@ -258,6 +806,7 @@ class RecipeFilteringTests(TestCase):
             'pass123'
         )
         self.client.force_authenticate(user=self.user)
+        cache.clear()
 
     def test_filter_recipes_by_tags(self):
         """Test returning recipes filtered by specific tags"""
@@ -278,9 +827,9 @@ class RecipeFilteringTests(TestCase):
         serializer2 = RecipeSerializer(recipe2)
         serializer3 = RecipeSerializer(recipe3)
 
-        self.assertIn(serializer1.data, resp.data)
-        self.assertIn(serializer2.data, resp.data)
-        self.assertNotIn(serializer3.data, resp.data)
+        self.assertIn(serializer1.data, resp.data['results'])
+        self.assertIn(serializer2.data, resp.data['results'])
+        self.assertNotIn(serializer3.data, resp.data['results'])
 
     def test_filter_recipes_by_ingredients(self):
         """Test returning recipes filtered by specific ingredients"""
@@ -301,6 +850,773 @@ class RecipeFilteringTests(TestCase):
         serializer2 = RecipeSerializer(recipe2)
         serializer3 = RecipeSerializer(recipe3)
 
-        self.assertIn(serializer1.data, resp.data)
-        self.assertIn(serializer2.data, resp.data)
-        self.assertNotIn(serializer3.data, resp.data)
\ No newline at end of file
+        self.assertIn(serializer1.data, resp.data['results'])
+        self.assertIn(serializer2.data, resp.data['results'])
+        self.assertNotIn(serializer3.data, resp.data['results'])
+
+    def test_filter_recipes_matching_all_tags(self):
+        """Test match=all returns only recipes with every given tag"""
+        recipe1 = sample_recipe(user=self.user, title='Veggie Fish Curry')
+        recipe2 = sample_recipe(user=self.user, title='Fish Tacos')
+        tag1 = sample_tag(user=self.user, name='Vegetarian')
+        tag2 = sample_tag(user=self.user, name='Fish-related')
+        recipe1.tags.add(tag1, tag2)
+        recipe2.tags.add(tag2)
+
+        resp = self.client.get(
+            RECIPES_URL,
+            {'tags': f'{tag1.id},{tag2.id}', 'match': 'all'}
+        )
+
+        self.assertEqual(
+            [r['id'] for r in resp.data['results']],
+            [recipe1.id]
+        )
+
+    @override_settings(RECIPE_BITMAP_INDEX=True)
+    def test_filter_recipes_from_bitmap_index(self):
+        """Test the bitmap index answers the same filters as the database"""
+        bitmaps.clear()
+        recipe1 = sample_recipe(user=self.user, title='Veggie Fish Curry')
+        recipe2 = sample_recipe(user=self.user, title='Fish Tacos')
+        recipe3 = sample_recipe(user=self.user, title='Beef Pie')
+        tag1 = sample_tag(user=self.user, name='Vegetarian')
+        tag2 = sample_tag(user=self.user, name='Fish-related')
+        ingredient = sample_ingredient(user=self.user, name='Tacos')
+        recipe1.tags.add(tag1, tag2)
+        recipe2.tags.add(tag2)
+        self.client.get(RECIPES_URL, {'tags': tag1.id})   # builds the index
+        recipe3.tags.add(tag1)
+        tag2.recipe_set.add(recipe3)
+        recipe2.ingredients.add(ingredient)
+
+        def filtered_ids(params):
+            resp = self.client.get(RECIPES_URL, params)
+            return sorted(r['id'] for r in resp.data['results'])
+
+        tags = f'{tag1.id},{tag2.id}'
+        self.assertEqual(
+            filtered_ids({'tags': tags}),
+            sorted([recipe1.id, recipe2.id, recipe3.id])
+        )
+        self.assertEqual(
+            filtered_ids({'tags': tags, 'match': 'all'}),
+            sorted([recipe1.id, recipe3.id])
+        )
+        self.assertEqual(
+            filtered_ids({'tags': tags, 'ingredients': ingredient.id}),
+            [recipe2.id]
+        )
+
+        recipe1.tags.remove(tag2)
+        recipe3.delete()
+        self.assertEqual(filtered_ids({'tags': tags, 'match': 'all'}), [])
+
+    def test_bitmap_index_follows_collection_version(self):
+        """Test the index is rebuilt after writes it wasn't told about,
+        such as those of other processes, without gaps for deleted recipes
+        """
+        bitmaps.clear()
+        recipe1 = sample_recipe(user=self.user)
+        recipe2 = sample_recipe(user=self.user)
+        tag = sample_tag(user=self.user)
+        recipe1.tags.add(tag)
+        self.assertEqual(bitmaps.get_index(self.user.id).resolve([tag.id]), [recipe1.id])
+
+        # no signals: as if another worker had linked the tag
+        Recipe.tags.through.objects.create(recipe=recipe2, tag=tag)
+        versions.bump(self.user.id)
+        self.assertEqual(
+            bitmaps.get_index(self.user.id).resolve([tag.id]), [recipe1.id, recipe2.id]
+        )
+
+        recipe1.delete()
+        index = bitmaps.get_index(self.user.id)
+        self.assertEqual(index.resolve([tag.id]), [recipe2.id])
+        self.assertEqual(index.recipe_ids, [recipe2.id])
+
+    def _pantry_recipes(self):
+        salt, egg, milk, flour = (
+            sample_ingredient(user=self.user, name=name)
+            for name in ('Salt', 'Egg', 'Milk', 'Flour')
+        )
+        omelette = sample_recipe(user=self.user, title='Omelette', time_minutes=5)
+        omelette.ingredients.add(salt, egg)
+        pancakes = sample_recipe(user=self.user, title='Pancakes', time_minutes=20)
+        pancakes.ingredients.add(egg, milk, flour)
+        bread = sample_recipe(user=self.user, title='Bread')
+        bread.ingredients.add(salt, flour)
+        sample_recipe(user=self.user, title='Water')      # has no ingredients
+        return (salt, egg, milk, flour), (omelette, pancakes, bread)
+
+    def _check_pantry(self):
+        (salt, egg, milk, flour), (omelette, pancakes, bread) = self._pantry_recipes()
+
+        def cookable(**params):
+            resp = self.client.post(PANTRY_URL, params, format='json')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            return [(r['id'], r['missing']) for r in resp.data]
+
+        self.assertEqual(cookable(ingredients=[salt.id, egg.id]), [(omelette.id, [])])
+        self.assertEqual(
+            cookable(ingredients=[salt.id, egg.id, milk.id], max_missing=1),
+            [(omelette.id, []), (bread.id, [flour.id]), (pancakes.id, [flour.id])]
+        )
+        self.assertEqual(
+            cookable(ingredients=[egg.id], max_missing=2),
+            [(omelette.id, [salt.id]),
+             (bread.id, [salt.id, flour.id]),
+             (pancakes.id, [milk.id, flour.id])]
+        )
+        self.assertEqual(
+            cookable(ingredients=[egg.id], max_missing=2, limit=2),
+            [(omelette.id, [salt.id]), (bread.id, [salt.id, flour.id])]
+        )
+
+        resp = self.client.post(
+            f'{PANTRY_URL}?time_minutes__gte=10',
+            {'ingredients': [egg.id], 'max_missing': 2}, format='json'
+        )
+        self.assertEqual([r['id'] for r in resp.data], [bread.id, pancakes.id])
+
+    def test_pantry_recipes(self):
+        """Test listing recipes cookable from a pantry, fewest missing first"""
+        self._check_pantry()
+
+    def test_pantry_reuses_index(self):
+        """Test pantry queries share the cached index until a write"""
+        bitmaps.clear()
+        egg = sample_ingredient(user=self.user, name='Egg')
+        sample_recipe(user=self.user).ingredients.add(egg)
+
+        with patch.object(bitmaps.RecipeBitmapIndex, 'build',
+                          wraps=bitmaps.RecipeBitmapIndex.build) as build:
+            for _ in range(2):
+                resp = self.client.post(PANTRY_URL, {'ingredients': [egg.id]}, format='json')
+                self.assertEqual(len(resp.data), 1)
+            self.assertEqual(build.call_count, 1)
+
+            sample_recipe(user=self.user).ingredients.add(egg)
+            resp = self.client.post(PANTRY_URL, {'ingredients': [egg.id]}, format='json')
+            self.assertEqual(len(resp.data), 2)
+            self.assertEqual(build.call_count, 2)
+
+    @override_settings(RECIPE_BITMAP_INDEX=True)
+    def test_pantry_recipes_from_bitmap_index(self):
+        """Test the pantry query from a prebuilt and updated bitmap index"""
+        bitmaps.clear()
+        bitmaps.get_index(self.user.id)
+        self._check_pantry()
+
+    def test_pantry_invalid(self):
+        """Test a pantry query needs ingredient ids and a sane max_missing"""
+        resp = self.client.post(
+            PANTRY_URL, {'ingredients': ['salt'], 'max_missing': -1}, format='json'
+        )
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(resp.data), {'ingredients', 'max_missing'})
+
+    def test_shopping_list(self):
+        """Test the ingredients of many recipes are listed once with counts"""
+        (salt, egg, milk, flour), (omelette, pancakes, bread) = self._pantry_recipes()
+        user2 = get_user_model().objects.create_user('other@gmail.com', 'pass123')
+        other = sample_recipe(user=user2)
+        other.ingredients.add(sample_ingredient(user=user2, name='Butter'))
+
+        with self.assertNumQueries(1):
+            resp = self.client.post(
+                SHOPPING_LIST_URL,
+                {'recipes': [omelette.id, pancakes.id, bread.id, other.id]},
+                format='json'
+            )
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data, [
+            {'id': egg.id, 'name': 'Egg', 'count': 2},
+            {'id': flour.id, 'name': 'Flour', 'count': 2},
+            {'id': milk.id, 'name': 'Milk', 'count': 1},
+            {'id': salt.id, 'name': 'Salt', 'count': 2},
+        ])
+
+    def test_shopping_list_invalid(self):
+        """Test a shopping list needs a list of recipe ids"""
+        resp = self.client.post(SHOPPING_LIST_URL, {'recipes': []}, format='json')
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_filter_recipes_by_ranges(self):
+        """Test filtering recipes by time and price ranges"""
+        quick = sample_recipe(user=self.user, time_minutes=20, price=12.00)
+        cheap = sample_recipe(user=self.user, time_minutes=45, price=6.50)
+        both = sample_recipe(user=self.user, time_minutes=30, price=10.00)
+
+        def filtered_ids(params):
+            resp = self.client.get(RECIPES_URL, params)
+            return sorted(r['id'] for r in resp.data['results'])
+
+        self.assertEqual(filtered_ids({'time_minutes__lte': 30}), [quick.id, both.id])
+        self.assertEqual(filtered_ids({'price__lte': '10.00'}), [cheap.id, both.id])
+        self.assertEqual(
+            filtered_ids({'time_minutes__lte': 30, 'price__lte': 10}), [both.id]
+        )
+        self.assertEqual(
+            filtered_ids({'time_minutes__gte': 25, 'price__gte': '7'}), [both.id]
+        )
+
+    def test_filter_recipes_invalid_range(self):
+        """Test a malformed range parameter is rejected"""
+        resp = self.client.get(RECIPES_URL, {'price__lte': 'cheap'})
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('price__lte', resp.data)
+
+    def test_order_recipes_across_pages(self):
+        """Test sorted recipes page through ties without gaps or repeats"""
+        prices = [5, 3, 5, 8, 3, 5]
+        recipes = [sample_recipe(user=self.user, price=price) for price in prices]
+        sample_recipe(user=self.user, price=1, time_minutes=90)
+
+        def pages(params):
+            ids, url = [], RECIPES_URL
+            while url:
+                with self.assertNumQueries(3):
+                    resp = self.client.get(url, params)
+                ids += [r['id'] for r in resp.data['results']]
+                url, params = resp.data['next'], None
+            return ids
+
+        params = {'ordering': '-price', 'time_minutes__lte': 60, 'page_size': 2}
+        expected = sorted(recipes, key=lambda r: (r.price, r.id), reverse=True)
+        self.assertEqual(pages(params), [r.id for r in expected])
+
+        params['ordering'] = 'price'
+        self.assertEqual(pages(params), [r.id for r in reversed(expected)])
+
+    def test_order_recipes_many_ties(self):
+        """Test pages past a thousand recipes sharing the sorted value
+        are keyed by id, forwards and backwards
+        """
+        Recipe.objects.bulk_create(
+            Recipe(user=self.user, title='Stew', time_minutes=30, price=5)
+            for _ in range(1300)
+        )
+        sample_recipe(user=self.user, time_minutes=10)
+        expected = list(Recipe.objects.order_by('time_minutes', 'id').values_list(
+            'id', flat=True))
+
+        ids, url, params = [], RECIPES_URL, {'ordering': 'time_minutes', 'page_size': 300}
+        while url:
+            resp = self.client.get(url, params)
+            ids += [r['id'] for r in resp.data['results']]
+            last, url, params = resp, resp.data['next'], None
+        self.assertEqual(ids, expected)
+
+        resp = self.client.get(last.data['previous'])
+        self.assertEqual([r['id'] for r in resp.data['results']], expected[900:1200])
+        self.assertIsNotNone(resp.data['next'])
+
+    def test_recipes_invalid_cursor(self):
+        """Test a cursor whose position doesn't fit the ordering is refused"""
+        resp = self.client.get(RECIPES_URL, {'ordering': 'price', 'cursor': 'cD1hYmMmcD0x'})
+
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RecipeIndexUpdateTests(TransactionTestCase):
+    """Test the in-memory indexes follow the committed writes of their
+    own process, which TestCase never commits
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('test@gmail.com', 'pass123')
+        bitmaps.clear()
+
+    def test_bitmap_index_updated_in_place(self):
+        """Test committed writes update the bitmap index without a rebuild,
+        while writes of other processes and rolled back ones rebuild it
+        """
+        recipe1 = sample_recipe(user=self.user)
+        recipe2 = sample_recipe(user=self.user)
+        tag = sample_tag(user=self.user)
+        recipe1.tags.add(tag)
+
+        with patch.object(bitmaps.RecipeBitmapIndex, 'build',
+                          wraps=bitmaps.RecipeBitmapIndex.build) as build:
+            self.assertEqual(bitmaps.get_index(self.user.id).resolve([tag.id]), [recipe1.id])
+            tag.recipe_set.add(recipe2)
+            recipe1.title = 'Renamed'
+            recipe1.save()
+            self.assertEqual(
+                bitmaps.get_index(self.user.id).resolve([tag.id]), [recipe1.id, recipe2.id]
+            )
+            recipe1.delete()
+            recipe3 = sample_recipe(user=self.user)
+            recipe3.tags.add(tag)
+            index = bitmaps.get_index(self.user.id)
+            self.assertEqual(sorted(index.resolve([tag.id])), [recipe2.id, recipe3.id])
+            self.assertEqual(len(index.recipe_ids), 2)  # recipe3 took recipe1's position
+            self.assertEqual(build.call_count, 1)
+
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    tag.recipe_set.clear()
+                    raise ValueError
+            self.assertEqual(len(bitmaps.get_index(self.user.id).resolve([tag.id])), 2)
+            self.assertEqual(build.call_count, 2)
+
+            # no signals: as if another worker had unlinked the tag
+            Recipe.tags.through.objects.filter(tag=tag).delete()
+            versions._incr(self.user.id)
+            self.assertEqual(bitmaps.get_index(self.user.id).resolve([tag.id]), [])
+            self.assertEqual(build.call_count, 3)
+
+    def test_similar_index_updated_in_place(self):
+        """Test committed M2M changes re-sign recipes in place, a title
+        edit leaving the index as it is
+        """
+        tags = [sample_tag(user=self.user, name=f'Tag {i}') for i in range(3)]
+        recipe1 = sample_recipe(user=self.user)
+        recipe1.tags.add(*tags)
+        recipe2 = sample_recipe(user=self.user)
+        recipe2.tags.add(*tags[:2])
+        similar.clear()
+
+        with patch.object(similar.SimilarityIndex, 'build',
+                          wraps=similar.SimilarityIndex.build) as build:
+            index = similar.get_index(self.user.id)
+            self.assertEqual(index.similar(recipe1.id), [(recipe2.id, 2 / 3)])
+            recipe2.tags.add(tags[2])
+            recipe2.title = 'Renamed'
+            recipe2.save()
+            index = similar.get_index(self.user.id)
+            self.assertEqual(index.similar(recipe1.id), [(recipe2.id, 1.0)])
+            tags[0].delete()
+            recipe2.delete()
+            self.assertEqual(similar.get_index(self.user.id).similar(recipe1.id), [])
+            self.assertEqual(index.elements[recipe1.id], {
+                similar._element('tags', tag.id) for tag in tags[1:]
+            })
+            self.assertEqual(build.call_count, 1)
+
+    def test_title_index_updated_in_place(self):
+        """Test committed title changes update the search index in place,
+        while rolled back ones rebuild it
+        """
+        recipe = sample_recipe(user=self.user, title='Fish Tacos')
+        recipe_search.clear()
+
+        with patch.object(recipe_search.TitleIndex, 'build',
+                          wraps=recipe_search.TitleIndex.build) as build:
+            self.assertEqual(list(recipe_search.get_index(self.user.id).search('tacos')),
+                             [recipe.id])
+            recipe.title = 'Fish Pie'
+            recipe.save()
+            self.assertEqual(list(recipe_search.get_index(self.user.id).search('pie')),
+                             [recipe.id])
+            self.assertEqual(build.call_count, 1)
+
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    recipe.title = 'Beef Stew'
+                    recipe.save()
+                    raise ValueError
+            index = recipe_search.get_index(self.user.id)
+            self.assertEqual(list(index.search('stew')), [])
+            self.assertEqual(list(index.search('pie')), [recipe.id])
+            self.assertEqual(build.call_count, 2)
+
+
+class RecipeSearchTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'test@gmail.com',
+            'pass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        cache.clear()
+        recipe_search.clear()
+
+    def search_ids(self, **params):
+        resp = self.client.get(RECIPES_URL, params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return [r['id'] for r in resp.data['results']]
+
+    def test_search_recipes_ranked(self):
+        """Test searching titles returns matches best first"""
+        recipe1 = sample_recipe(user=self.user, title='Red Curry')
+        recipe2 = sample_recipe(user=self.user, title='Thai Green Curry')
+        recipe3 = sample_recipe(user=self.user, title='Beef Pie')
+
+        ids = self.search_ids(search='green curry')
+
+        self.assertEqual(ids[0], recipe2.id)
+        self.assertNotIn(recipe3.id, ids)
+        self.assertNotIn(recipe1.id, ids[:1])
+
+    def test_search_tracks_title_changes(self):
+        """Test search results follow created, renamed and deleted recipes"""
+        recipe1 = sample_recipe(user=self.user, title='Fish Tacos')
+        self.assertEqual(self.search_ids(search='tacos'), [recipe1.id])
+
+        recipe2 = sample_recipe(user=self.user, title='Beef Tacos')
+        recipe1.title = 'Fish Pie'
+        recipe1.save()
+        self.assertEqual(self.search_ids(search='tacos'), [recipe2.id])
+
+        recipe2.delete()
+        self.assertEqual(self.search_ids(search='tacos'), [])
+
+    def test_search_follows_collection_version(self):
+        """Test the title index is rebuilt after writes it wasn't told
+        about, such as those of other processes
+        """
+        recipe = sample_recipe(user=self.user, title='Fish Tacos')
+        self.assertEqual(self.search_ids(search='tacos'), [recipe.id])
+
+        # no signals: as if another worker had renamed it
+        Recipe.objects.filter(pk=recipe.pk).update(title='Fish Pie')
+        versions.bump(self.user.id)
+        self.assertEqual(self.search_ids(search='tacos'), [])
+        self.assertEqual(self.search_ids(search='pie'), [recipe.id])
+
+    def test_search_pages_many_ties(self):
+        """Test results of equal rank are paged by id, however many"""
+        Recipe.objects.bulk_create(
+            Recipe(user=self.user, title='Chicken Soup', time_minutes=30, price=5)
+            for _ in range(1300)
+        )
+        expected = list(Recipe.objects.order_by('-id').values_list('id', flat=True))
+
+        ids, url, params = [], RECIPES_URL, {'search': 'chicken', 'page_size': 300}
+        while url:
+            resp = self.client.get(url, params)
+            ids += [r['id'] for r in resp.data['results']]
+            url, params = resp.data['next'], None
+
+        self.assertEqual(ids, expected)
+
+    def test_search_combined_with_tags(self):
+        """Test search results can be filtered by tags"""
+        recipe1 = sample_recipe(user=self.user, title='Fish Tacos')
+        sample_recipe(user=self.user, title='Beef Tacos')
+        tag = sample_tag(user=self.user, name='Fish-related')
+        recipe1.tags.add(tag)
+
+        self.assertEqual(self.search_ids(search='tacos', tags=tag.id), [recipe1.id])
+
+    def test_search_limited_to_user(self):
+        """Test search only returns the authenticated user's recipes"""
+        user2 = get_user_model().objects.create_user('other@gmail.com', 'pass123')
+        sample_recipe(user=user2, title='Fish Tacos')
+
+        self.assertEqual(self.search_ids(search='tacos'), [])
+
+
+class RecipeSimilarTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'test@gmail.com',
+            'pass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        cache.clear()
+        similar.clear()
+        self.tags = [sample_tag(user=self.user, name=f'Tag {i}') for i in range(2)]
+        self.ingredients = [
+            sample_ingredient(user=self.user, name=f'Ingredient {i}') for i in range(3)
+        ]
+
+    def sample_recipe(self, title='Curry'):
+        recipe = sample_recipe(user=self.user, title=title)
+        recipe.tags.add(*self.tags)
+        recipe.ingredients.add(*self.ingredients)
+        return recipe
+
+    def similar_scores(self, recipe, **params):
+        resp = self.client.get(similar_url(recipe.id), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return [(r['id'], r['similarity']) for r in resp.data]
+
+    def test_similar_recipes(self):
+        """Test similar recipes are ranked by shared tags and ingredients"""
+        recipe1 = self.sample_recipe()
+        recipe2 = self.sample_recipe()
+        recipe3 = self.sample_recipe()
+        recipe3.ingredients.remove(self.ingredients[2])
+        sample_recipe(user=self.user, title='Toast')       # nothing in common
+
+        self.assertEqual(
+            self.similar_scores(recipe1), [(recipe2.id, 1.0), (recipe3.id, 0.8)]
+        )
+        self.assertEqual(self.similar_scores(recipe1, limit=1), [(recipe2.id, 1.0)])
+
+    def test_similar_tracks_changes(self):
+        """Test the index follows link changes after it was built"""
+        recipe1 = self.sample_recipe()
+        recipe2 = self.sample_recipe()
+        self.assertEqual(self.similar_scores(recipe1), [(recipe2.id, 1.0)])
+
+        recipe2.tags.clear()
+        self.assertEqual(self.similar_scores(recipe1), [(recipe2.id, 0.6)])
+
+        recipe3 = self.sample_recipe()
+        recipe2.delete()
+        self.assertEqual(self.similar_scores(recipe1), [(recipe3.id, 1.0)])
+
+    def test_similar_follows_collection_version(self):
+        """Test the index is rebuilt after writes it wasn't told about,
+        such as those of other processes
+        """
+        recipe1 = self.sample_recipe()
+        recipe2 = sample_recipe(user=self.user)
+        self.assertEqual(self.similar_scores(recipe1), [])
+
+        # no signals: as if another worker had linked them
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe=recipe2, tag=tag) for tag in self.tags
+        )
+        Recipe.ingredients.through.objects.bulk_create(
+            Recipe.ingredients.through(recipe=recipe2, ingredient=ingredient)
+            for ingredient in self.ingredients[:2]
+        )
+        versions.bump(self.user.id)
+        self.assertEqual(self.similar_scores(recipe1), [(recipe2.id, 0.8)])
+
+    def test_similar_limited_to_user(self):
+        """Test other users' recipes are neither returned nor reachable"""
+        user2 = get_user_model().objects.create_user('other@gmail.com', 'pass123')
+        recipe1 = self.sample_recipe()
+        recipe2 = sample_recipe(user=user2)
+
+        self.assertEqual(self.similar_scores(recipe1), [])
+        resp = self.client.get(similar_url(recipe2.id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RecipeImageResizeTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'tester@gmail.com',
+            'pass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.recipe = sample_recipe(user=self.user)
+        out = io.BytesIO()
+        Image.new('RGB', (64, 32), 'red').save(out, format='PNG')
+        self.recipe.image.save('photo.png', ContentFile(out.getvalue()))
+        self.addCleanup(os.remove, self.recipe.image.path)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        settings = override_settings(
+            RECIPE_RESIZE_CACHE_DIR=self.cache_dir, RECIPE_RESIZE_WIDTHS=(16, 32)
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # render in a thread of the test process, counting the renders
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        self.executor = Mock(wraps=executor)
+        patcher = patch('recipe.images.get_executor', return_value=self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resize_redirects_to_current_version(self):
+        """Test unversioned requests are redirected and never cached"""
+        resp = self.client.get(resize_url(self.recipe.id), {'w': 32, 'fmt': 'png'})
+
+        self.assertEqual(resp.status_code, status.HTTP_302_FOUND)
+        version = resize.image_version(self.recipe.image.name)
+        self.assertIn(f'v={version}', resp['Location'])
+        self.assertIn('no-cache', resp['Cache-Control'])
+        self.executor.submit.assert_not_called()
+
+    def test_resize_rounds_width_up(self):
+        """Test other widths are redirected to the next rendered one"""
+        version = resize.image_version(self.recipe.image.name)
+        resp = self.client.get(resize_url(self.recipe.id), {'w': 20, 'v': version})
+
+        self.assertEqual(resp.status_code, status.HTTP_302_FOUND)
+        self.assertIn('w=32', resp['Location'])
+        resp = self.client.get(resize_url(self.recipe.id), {'w': 500, 'v': version})
+        self.assertIn('w=32', resp['Location'])
+        self.executor.submit.assert_not_called()
+
+    def test_resize_follows_exif_orientation(self):
+        """Test a sideways stored photo is resized upright"""
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as ntf:
+            ntf.write(sideways_jpeg((64, 32)))
+            ntf.flush()
+            data = resize.render_resized(ntf.name, 16, 'png')
+
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (16, 32))
+
+    def test_resize_renders_once(self):
+        """Test the first request renders the size and later ones reuse it"""
+        params = {'w': 32, 'fmt': 'png', 'v': resize.image_version(self.recipe.image.name)}
+        resp = self.client.get(resize_url(self.recipe.id), params)
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertIn('immutable', resp['Cache-Control'])
+        image = Image.open(io.BytesIO(b''.join(resp.streaming_content)))
+        self.assertEqual((image.format, image.size), ('PNG', (32, 16)))
+
+        resp = self.client.get(resize_url(self.recipe.id), params)
+        b''.join(resp.streaming_content)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.executor.submit.assert_called_once()
+
+        resp = self.client.get(resize_url(self.recipe.id), params, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_resize_coalesces_concurrent_requests(self):
+        """Test requests for a size being rendered wait for that render"""
+        render = Future()
+        self.executor.submit.side_effect = lambda *args: render
+        paths = []
+
+        def request():
+            paths.append(resize.resized(self.recipe.image.name, 16, 'png'))
+
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        render.set_result(resize.render_resized(self.recipe.image.path, 16, 'png'))
+        for thread in threads:
+            thread.join()
+
+        self.executor.submit.assert_called_once()
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(len(paths), 4)
+
+    @skipUnless(features.check('webp'), 'Pillow is built without WebP')
+    def test_resize_webp(self):
+        """Test images are resized to WebP where Pillow supports it"""
+        params = {'w': 16, 'fmt': 'webp', 'v': resize.image_version(self.recipe.image.name)}
+        resp = self.client.get(resize_url(self.recipe.id), params)
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp['Content-Type'], 'image/webp')
+        image = Image.open(io.BytesIO(b''.join(resp.streaming_content)))
+        self.assertEqual((image.format, image.size), ('WEBP', (16, 8)))
+
+    def test_resize_invalid_params(self):
+        """Test unknown formats and other users' recipes are refused"""
+        resp = self.client.get(resize_url(self.recipe.id), {'w': 32, 'fmt': 'tiff'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(resize_url(self.recipe.id), {'w': 0})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        user2 = get_user_model().objects.create_user('other@gmail.com', 'pass123')
+        recipe2 = sample_recipe(user=user2)
+        resp = self.client.get(resize_url(recipe2.id), {'w': 32})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_disk_cache_evicts_least_recently_used(self):
+        """Test the cache stays under its byte cap, dropping the oldest use"""
+        cache = resize.DiskCache(self.cache_dir, 250)
+        paths = [cache.path(key * 64, 'png') for key in 'abc']
+        cache.put(paths[0], b'x' * 100)
+        cache.put(paths[1], b'x' * 100)
+        os.utime(paths[0], (1000, 1000))
+        os.utime(paths[1], (2000, 2000))
+        self.assertTrue(cache.get(paths[0]))
+
+        cache.put(paths[2], b'x' * 100)
+
+        self.assertEqual([os.path.exists(path) for path in paths], [True, False, True])
+        self.assertEqual(cache.size, 200)
+        self.assertFalse(cache.get(paths[1]))
+
+
+class RecipeMediaTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'tester@gmail.com',
+            'pass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.recipe = sample_recipe(user=self.user)
+        self.data = bytes(range(256)) * 4
+        self.recipe.image.save('photo.png', ContentFile(self.data))
+        self.addCleanup(os.remove, self.recipe.image.path)
+        self.url = media_url(self.recipe.image.name)
+
+    def test_media_served_to_owner(self):
+        """Test the owner gets the file, other users and anonymous don't"""
+        resp = self.client.get(self.url)
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(resp.streaming_content), self.data)
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertEqual(resp['Accept-Ranges'], 'bytes')
+        self.assertIn('private', resp['Cache-Control'])
+
+        user2 = get_user_model().objects.create_user('other@gmail.com', 'pass123')
+        self.client.force_authenticate(user=user2)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.client.force_authenticate(user=None)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_media_variant_served_to_owner(self):
+        """Test variants are authorized through their original image"""
+        name = images.variant_name(self.recipe.image.name, 'thumb')
+        default_storage.save(name, ContentFile(b'thumb'))
+        self.addCleanup(default_storage.delete, name)
+
+        resp = self.client.get(media_url(name))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(resp.streaming_content), b'thumb')
+
+        resp = self.client.get(media_url(name.replace('_thumb', '_huge')))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_media_byte_ranges(self):
+        """Test single byte ranges are answered with 206 Partial Content"""
+        size = len(self.data)
+        for header, start, end in (('bytes=2-5', 2, 6), ('bytes=1000-', 1000, size),
+                                   ('bytes=-4', size - 4, size), ('bytes=10-99999', 10, size)):
+            resp = self.client.get(self.url, HTTP_RANGE=header)
+            self.assertEqual(resp.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join(resp.streaming_content), self.data[start:end])
+            self.assertEqual(resp['Content-Range'], f'bytes {start}-{end - 1}/{size}')
+            self.assertEqual(resp['Content-Length'], str(end - start))
+
+        resp = self.client.get(self.url, HTTP_RANGE=f'bytes={size}-')
+        self.assertEqual(resp.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(resp['Content-Range'], f'bytes */{size}')
+
+        # several ranges, or a stale If-Range, get the whole file
+        resp = self.client.get(self.url, HTTP_RANGE='bytes=0-1,4-5')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(resp.streaming_content), self.data)
+
+    def test_media_delegated_to_proxy(self):
+        """Test the proxy is handed the file with the accel headers"""
+        with self.settings(RECIPE_MEDIA_ACCEL='x-accel-redirect'):
+            resp = self.client.get(self.url)
+        media_dir = os.path.basename(default_storage.location.rstrip('/'))
+        self.assertEqual(
+            resp['X-Accel-Redirect'], f'/protected/{media_dir}/{self.recipe.image.name}'
+        )
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertEqual(resp.content, b'')
+
+        with self.settings(RECIPE_MEDIA_ACCEL='x-sendfile'):
+            resp = self.client.get(self.url)
+        self.assertEqual(resp['X-Sendfile'], self.recipe.image.path)
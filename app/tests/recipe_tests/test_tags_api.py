@@ -1,14 +1,20 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
 from django.urls import reverse
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from rest_framework import status
 from rest_framework.test import APIClient
 
 from core.models import Tag, Recipe
+from recipe import autocomplete
 from recipe.serializers import TagSerializer
 
 TAGS_URL = reverse('recipe:tag-list')
+TAGS_BULK_URL = reverse('recipe:tag-bulk')
+TAGS_AUTOCOMPLETE_URL = reverse('recipe:tag-autocomplete')
 
 
 class PublicTagsAPITest(TestCase):
@@ -34,6 +40,7 @@ class PrivateTagsAPITest(TestCase):
             'password123',
         )
         self.client.force_authenticate(user=self.user)
+        cache.clear()
 
     def test_retrieve_tags(self):
         """Test multiple tags are retrieved"""
@@ -61,6 +68,30 @@ class PrivateTagsAPITest(TestCase):
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0]['name'], tag.name)
 
+    def test_retrieve_tags_sparse_fields(self):
+        """Test ?fields= limits the tag fields returned"""
+        Tag.objects.create(user=self.user, name='Vegan')
+
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(TAGS_URL, {'fields': 'name'})
+
+        self.assertEqual(resp.data, [{'name': 'Vegan'}])
+        select = queries.captured_queries[-1]['sql'].split(' FROM ')[0]
+        self.assertNotIn('recipe_count', select)
+
+    def test_retrieve_tags_not_modified(self):
+        """Test an unchanged tag list is answered with 304"""
+        Tag.objects.create(user=self.user, name='Vegan')
+        etag = self.client.get(TAGS_URL)['ETag']
+
+        resp = self.client.get(TAGS_URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Tag.objects.create(user=self.user, name='Dessert')
+        resp = self.client.get(TAGS_URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.data), 2)
+
     def test_create_tag_successful(self):
         """Test creating a new tag"""
         payload = {'name': 'Test Tag'}
@@ -73,6 +104,59 @@ class PrivateTagsAPITest(TestCase):
 
         self.assertTrue(exists)
 
+    def test_create_tag_dedupes_names(self):
+        """Test creating a tag with an existing name returns that tag"""
+        tag = Tag.objects.create(user=self.user, name='Salt')
+
+        resp = self.client.post(TAGS_URL, {'name': ' salt  '})
+
+        self.assertEqual(resp.data['id'], tag.id)
+        self.assertEqual(Tag.objects.filter(user=self.user).count(), 1)
+
+    def test_create_tag_non_ascii_name(self):
+        """Test non-ASCII names are created and deduped"""
+        resp = self.client.post(TAGS_URL, {'name': 'Éclair'})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        resp2 = self.client.post(TAGS_URL, {'name': 'Éclair '})
+        self.assertEqual(resp2.data['id'], resp.data['id'])
+
+        resp = self.client.post(TAGS_BULK_URL, ['Éclair', 'Crème brûlée'], format='json')
+        self.assertEqual(resp.data['Éclair'], resp2.data['id'])
+        self.assertEqual(
+            resp.data['Crème brûlée'], Tag.objects.get(name='Crème brûlée').id
+        )
+
+    def test_bulk_get_or_create_tags(self):
+        """Test bulk tags resolve existing names and create missing ones"""
+        user2 = get_user_model().objects.create_user('other@gmail.com', 'password123')
+        Tag.objects.create(user=user2, name='Dessert')
+        tag = Tag.objects.create(user=self.user, name='Salt')
+        names = ['SALT', 'Dessert', 'dessert', 'Quick   lunch']
+
+        with self.assertNumQueries(5):
+            resp = self.client.post(TAGS_BULK_URL, names, format='json')
+
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        tags = Tag.objects.filter(user=self.user)
+        self.assertEqual(
+            sorted(tags.values_list('name', flat=True)),
+            ['Dessert', 'Quick lunch', 'Salt']
+        )
+        self.assertEqual(resp.data['SALT'], tag.id)
+        self.assertEqual(resp.data['Dessert'], resp.data['dessert'])
+        self.assertEqual(resp.data['Quick   lunch'], tags.get(name='Quick lunch').id)
+
+        resp = self.client.post(TAGS_BULK_URL, ['salt'], format='json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_bulk_tags_invalid(self):
+        """Test bulk tags reject blank names"""
+        resp = self.client.post(TAGS_BULK_URL, ['Salt', ''], format='json')
+
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Tag.objects.exists())
+
     def test_create_tag_invalid(self):
         """Test creating a new Tag with invalid payload"""
         payload = {'name': ''}
@@ -94,6 +178,7 @@ class PrivateTagsAPITest(TestCase):
 
         resp = self.client.get(TAGS_URL, {'assigned_only': 1})
 
+        tag1.refresh_from_db()
         serializer1 = TagSerializer(tag1)
         serializer2 = TagSerializer(tag2)
 
@@ -123,6 +208,88 @@ class PrivateTagsAPITest(TestCase):
 
         self.assertEqual(len(resp.data), 1)
 
+    def test_retrieve_tags_min_recipes(self):
+        """Test filtering tags by a minimum number of recipes"""
+        tag1 = Tag.objects.create(user=self.user, name='Dinner')
+        tag2 = Tag.objects.create(user=self.user, name='Cocktails')
+        Tag.objects.create(user=self.user, name='Breakfast')
+        for title in ('Beef Tartar', 'Venison salad'):
+            recipe = Recipe.objects.create(
+                user=self.user,
+                title=title,
+                time_minutes=15,
+                price=5.00
+            )
+            recipe.tags.add(tag1)
+        recipe.tags.add(tag2)
+
+        resp = self.client.get(TAGS_URL, {'min_recipes': 2})
+        self.assertEqual([t['id'] for t in resp.data], [tag1.id])
+
+        resp = self.client.get(TAGS_URL, {'min_recipes': 1})
+        self.assertEqual([t['id'] for t in resp.data], [tag1.id, tag2.id])
+
+        resp = self.client.get(TAGS_URL, {'min_recipes': 'abc'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('min_recipes', resp.data)
+
+        resp = self.client.get(TAGS_URL, {'assigned_only': 'x'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('assigned_only', resp.data)
+
+    def test_retrieve_tags_ordered_by_recipe_count(self):
+        """Test tags carry their recipe count and can be sorted by it"""
+        tag1 = Tag.objects.create(user=self.user, name='Dinner')
+        tag2 = Tag.objects.create(user=self.user, name='Cocktails')
+        tag3 = Tag.objects.create(user=self.user, name='Breakfast')
+        for title in ('Beef Tartar', 'Venison salad'):
+            recipe = Recipe.objects.create(
+                user=self.user,
+                title=title,
+                time_minutes=15,
+                price=5.00
+            )
+            recipe.tags.add(tag2)
+        recipe.tags.add(tag3)
+
+        resp = self.client.get(TAGS_URL, {'ordering': '-recipe_count'})
+        self.assertEqual(
+            [(t['id'], t['recipe_count']) for t in resp.data],
+            [(tag2.id, 2), (tag3.id, 1), (tag1.id, 0)]
+        )
+
+        resp = self.client.get(TAGS_URL, {'ordering': 'id'})
+        self.assertEqual([t['id'] for t in resp.data], [tag1.id, tag2.id, tag3.id])
+
+    def test_autocomplete_tags(self):
+        """Test prefix matches are ranked by use and follow writes"""
+        autocomplete.clear()
+        user2 = get_user_model().objects.create_user('other@gmail.com', 'pass123')
+        Tag.objects.create(user=user2, name='Dinner party')
+        dinner = Tag.objects.create(user=self.user, name='Dinner')
+        diet = Tag.objects.create(user=self.user, name='Diet')
+        Tag.objects.create(user=self.user, name='Breakfast')
+        recipe = Recipe.objects.create(
+            user=self.user, title='Salad', time_minutes=5, price=3.00
+        )
+        recipe.tags.add(diet)
+
+        def names(**params):
+            resp = self.client.get(TAGS_AUTOCOMPLETE_URL, params)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            return [(t['name'], t['recipe_count']) for t in resp.data]
+
+        self.assertEqual(names(q='di'), [('Diet', 1), ('Dinner', 0)])
+        self.assertEqual(names(q='DIN'), [('Dinner', 0)])
+        self.assertEqual(names(q='di', limit=1), [('Diet', 1)])
+        self.assertEqual(names(q='x'), [])
+
+        recipe.tags.set([dinner])
+        Tag.objects.create(user=self.user, name='Dim sum')
+        self.assertEqual(
+            names(q='di'), [('Dinner', 1), ('Diet', 0), ('Dim sum', 0)]
+        )
+
 ## response.data returns:
 # [ # OrderedDict(
 # [ ('id', 5), ('name', 'Italian') ]